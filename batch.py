@@ -0,0 +1,246 @@
+#!/usr/bin/python3 -u
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+
+import hashlib
+from mmap import mmap, ACCESS_READ
+
+import random
+import tarfile
+import shutil
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from server import process_logfile, render_lock
+from uploads import tar_members
+from locks import try_lock, remove_lock
+import catalog
+import search
+import storage
+
+
+tar_suffixes = ('.tar', '.tar.xz', '.txz', '.tar.gz', '.tgz', '.tar.bz2')
+
+_100MB = 1024 * 1024 * 100
+
+
+def file_digest(filename):
+  with open(filename, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as file:
+    return hashlib.md5(file).hexdigest()
+
+def count_lines(filename):
+  lines = 0
+  with open(filename, 'rb') as f:
+    while True:
+      chunk = f.read(1024 * 1024)
+      if not chunk:
+        break
+      lines += chunk.count(b'\n')
+  return lines
+
+def import_log(logfile):
+  if os.path.getsize(logfile) < 100:
+    return ''
+
+  digest = file_digest(logfile)
+  store = storage.get()
+  if not store.exists(f'{digest}.log'):
+    tempname = os.path.join('cache/', str(random.getrandbits(128)))
+    shutil.copyfile(logfile, tempname)
+    store.put(f'{digest}.log', tempname)
+  catalog.add(digest)
+  return digest
+
+def import_tarball(tarname):
+  temp_dest = os.path.join('cache/', str(random.getrandbits(128)))
+  digest = ''
+  found = {}
+
+  try:
+    with tarfile.open(tarname, 'r:*') as tar:
+      for member in tar.getmembers():
+        name = os.path.basename(member.name)
+        if not name in tar_members:
+          continue
+
+        if not member.isfile() or member.size > _100MB or member.size < 100:
+          logging.warning('skipping %s in %s\n', member.name, tarname)
+          continue
+
+        member.name = name
+        tar.extract(member, path=temp_dest)
+        found[name] = os.path.join(temp_dest, name)
+
+    if 'klippy.log' in found:
+      digest = file_digest(found['klippy.log'])
+      store = storage.get()
+      for name in found:
+        filename = f'{digest}{tar_members[name]}'
+        if not store.exists(filename):
+          store.put(filename, found[name])
+      catalog.add(digest)
+  finally:
+    shutil.rmtree(temp_dest, ignore_errors=True)
+
+  return digest
+
+def collect_inputs(paths):
+  inputs = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+          if file == 'klippy.log' or (file.startswith('klippy.log') and not file.endswith(tar_suffixes)) or file.endswith(tar_suffixes):
+            inputs += [os.path.join(root, file)]
+    else:
+      inputs += [path]
+  return inputs
+
+def cached_digests():
+  files = [f for f in storage.get().listing() if f.endswith('.log') and not '_' in f]
+  return [f.split('.')[0] for f in files]
+
+def expire(days):
+  # removes every file of uploads neither uploaded nor viewed within days
+  catalog.sync()
+  digests = catalog.expired(days)
+  store = storage.get()
+  objects = store.listing()
+  names = os.listdir('cache')
+  removed = []
+  for digest in digests:
+    # a server process rendering the log holds the lock, it is being viewed
+    lock = try_lock(render_lock(digest))
+    if lock is None:
+      continue
+    with lock:
+      for name in objects:
+        if name.startswith((f'{digest}.', f'{digest}_')):
+          store.remove(name)
+      # local copies and working files, the lock file is removed below
+      # once it is released
+      for name in names:
+        filename = os.path.join('cache', name)
+        if name.startswith((f'{digest}.', f'{digest}_')) and name != f'{digest}.lock' and os.path.exists(filename):
+          os.remove(filename)
+      catalog.remove(digest)
+      search.forget(digest)
+    removed += [digest]
+
+  # lock files of uploads no longer in the catalog, expired now or before
+  for name in os.listdir('cache'):
+    digest = name[:-len('.lock')]
+    if name.endswith('.lock') and catalog.is_digest(digest) and catalog.get(digest) is None:
+      remove_lock(os.path.join('cache', name))
+  return removed
+
+def render(digest, outdir, write_json):
+  logfile = storage.get().fetch(f'{digest}.log')
+  htmlfile = os.path.join(outdir, f'{digest}.html')
+  if logfile is None:
+    # removed from the store since the digests were listed
+    return (digest, 0, 0, 0., f'{digest}.log is not stored')
+
+  size = os.path.getsize(logfile)
+  lines = count_lines(logfile)
+
+  start = time.perf_counter()
+  try:
+    summary = process_logfile(digest, htmlfile, parallel=False)
+    error = ''
+  except Exception as e:
+    summary = None
+    error = f'{type(e).__name__}: {e}'
+  elapsed = time.perf_counter() - start
+
+  if summary is not None and os.path.abspath(outdir) == os.path.abspath('cache'):
+    html_size = os.path.getsize(htmlfile)
+    storage.get().put(f'{digest}.html', htmlfile)
+    catalog.rendered(digest, html_size, summary)
+
+  if write_json and summary is not None:
+    with open(os.path.join(outdir, f'{digest}.json'), 'w') as f:
+      json.dump(summary, f)
+
+  return (digest, size, lines, elapsed, error)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Offline batch rendering of klippy logs')
+  parser.add_argument('paths', nargs='*', help='klippy.log files, log tarballs or directories to import')
+  parser.add_argument('--all', action='store_true', help='re-render every log already stored in the cache')
+  parser.add_argument('--root', default='.', help='server directory containing cache/ (default: current directory)')
+  parser.add_argument('--output', default='cache', help='directory for rendered html/json (default: cache)')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+  parser.add_argument('--no-json', action='store_true', help='do not write json summaries')
+  parser.add_argument('--expire', type=float, metavar='DAYS', help='delete uploads not uploaded or viewed in DAYS days')
+  parser.add_argument('--skip-existing', action='store_true', help='do not re-render digests that already have html output')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.WARNING)
+
+  paths = [os.path.abspath(p) for p in args.paths]
+  os.chdir(args.root)
+  os.makedirs('cache', exist_ok=True)
+  os.makedirs(args.output, exist_ok=True)
+
+  if args.expire is not None:
+    expired = expire(args.expire)
+    print(f'expired {len(expired)} logs older than {args.expire:g} days')
+    if not paths and not args.all:
+      return 0
+
+  digests = []
+  for path in collect_inputs(paths):
+    if path.endswith(tar_suffixes):
+      digest = import_tarball(path)
+    else:
+      digest = import_log(path)
+    if not digest:
+      print('skipped', path)
+      continue
+    digests += [digest]
+
+  if args.all:
+    digests += cached_digests()
+
+  digests = list(dict.fromkeys(digests))
+  if args.skip_existing:
+    digests = [d for d in digests if not os.path.exists(os.path.join(args.output, f'{d}.html'))]
+
+  if not digests:
+    print('nothing to render')
+    return 0
+
+  print(f'rendering {len(digests)} logs with {args.workers} workers')
+
+  total_size = total_lines = failed = 0
+  start = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=args.workers) as pool:
+    futures = [pool.submit(render, digest, args.output, not args.no_json) for digest in digests]
+    for future in as_completed(futures):
+      digest, size, lines, elapsed, error = future.result()
+      if error:
+        failed += 1
+        print(f'{digest} failed: {error}')
+        continue
+      total_size += size
+      total_lines += lines
+      print(f'{digest} {size / 1048576.:.1f}MB {lines} lines {elapsed:.2f}s')
+  elapsed = time.perf_counter() - start
+
+  mbs = total_size / 1048576. / elapsed
+  lps = total_lines / elapsed
+  print(f'rendered {len(digests) - failed} logs ({failed} failed), {total_size / 1048576.:.1f}MB {total_lines} lines in {elapsed:.2f}s')
+  print(f'throughput: {mbs:.2f} MB/s, {lps:.0f} lines/s')
+
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
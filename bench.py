@@ -0,0 +1,365 @@
+#!/usr/bin/python3 -u
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import argparse
+import resource
+import tempfile
+import datetime
+
+import random
+import asyncio
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+KCONFIG = '''CONFIG_MACH_STM32=y
+CONFIG_MACH_STM32F446=y
+CONFIG_STM32_SELECT=y
+CONFIG_MCU="stm32f446xx"
+CONFIG_CLOCK_FREQ=180000000
+CONFIG_USBSERIAL=y
+CONFIG_STM32_FLASH_START_8000=y
+CONFIG_STM32_CLOCK_REF_12M=y
+CONFIG_WANT_GPIO_BITBANGING=y
+CONFIG_WANT_DISPLAYS=y
+CONFIG_WANT_SENSORS=y
+CONFIG_WANT_LIS2DW=y
+CONFIG_CANBUS_FREQUENCY=1000000
+'''
+
+TRACEBACK = '''Traceback (most recent call last):
+  File "/home/pi/klipper/klippy/klippy.py", line 130, in _connect
+    self.send_event("klippy:mcu_identify")
+  File "/home/pi/klipper/klippy/klippy.py", line 223, in send_event
+    return [cb(*params) for cb in self.event_handlers.get(event, [])]
+  File "/home/pi/klipper/klippy/mcu.py", line 740, in _mcu_identify
+    self._serial.connect_uart(self._serialport, self._baud, rts)
+  File "/home/pi/klipper/klippy/serialhdl.py", line 183, in connect_uart
+    self._error("Unable to connect")
+  File "/home/pi/klipper/klippy/serialhdl.py", line 61, in _error
+    raise error(self.warn_prefix + (msg % params))
+serialhdl.error: mcu 'mcu': Unable to connect'''
+
+
+class LogGenerator:
+  def __init__(self, mcus=2, heaters=2, seed=0):
+    self.rand = random.Random(seed)
+    self.mcus = ['mcu'] + [f'mcu{n}' for n in range(1, mcus)]
+    self.heaters = ['extruder', 'heater_bed'] + [f'heater_generic h{n}' for n in range(2, heaters)]
+    self.heaters = self.heaters[:heaters]
+    self.date = datetime.datetime(2023, 5, 8, 12, 0, 0)
+    self.eventtime = 100.
+    self.version = 'v0.11.0-245-g3d6c1a4b'
+
+  def session_header(self):
+    r = self.rand
+    asctime = self.date.strftime('%a %b %d %H:%M:%S %Y')
+    lines = [
+      'Starting Klippy...',
+      "Args: ['/home/pi/klipper/klippy/klippy.py', '/home/pi/printer_data/config/printer.cfg', '-l', '/home/pi/printer_data/logs/klippy.log']",
+      f"Git version: '{self.version}'",
+      'Branch: master',
+      'Remote: origin',
+      'Tracked URL: https://github.com/Klipper3d/klipper',
+      'CPU: 4 core ARMv7 Processor rev 4 (v7l)',
+      "Python: '3.9.2 (default, Feb 28 2021, 17:03:44) \\n[GCC 10.2.1 20210110]'",
+      f'Start printer at {asctime} ({self.date.timestamp():.1f} {self.eventtime:.1f})',
+      '===== Config file =====',
+    ]
+    for mcu in self.mcus:
+      section = 'mcu' if mcu == 'mcu' else f'mcu {mcu}'
+      lines += [f'[{section}]', f'serial = /dev/serial/by-id/usb-Klipper_stm32f446xx_{r.getrandbits(48):012X}-if00', '']
+    for axis in 'xyz':
+      lines += [f'[stepper_{axis}]', 'step_pin = PF13', 'dir_pin = PF12', 'enable_pin = !PF14', 'microsteps = 16',
+                f'rotation_distance = {40 if axis != "z" else 8}', 'endstop_pin = PG6', 'position_max = 300', '']
+    for heater in self.heaters:
+      lines += [f'[{heater}]', 'heater_pin = PA2', 'sensor_type = EPCOS 100K B57560G104F', 'sensor_pin = PF4',
+                'control = pid', 'pid_kp = 22.2', 'pid_ki = 1.08', 'pid_kd = 114', 'min_temp = 0', 'max_temp = 250', '']
+    for n in range(r.randint(100, 300)):
+      lines += [f'variable_{n} = {r.random():.4f}']
+    lines += ['=======================', 'Extruder max_extrude_ratio=0.266081']
+    for mcu in self.mcus:
+      lines += [
+        f"mcu '{mcu}': Starting serial connect",
+        f"Loaded MCU '{mcu}' 112 commands ({self.version} / gcc: (15:8-2019-q3-1+b1) 8.3.1 20190703 binutils: (2.35.2-2+14+b2) 2.35.2)",
+        f"MCU '{mcu}' config: ADC_MAX=4095 BUS_PINS_i2c1=PB6,PB7 CLOCK_FREQ=180000000 MCU=stm32f446xx RESERVE_PINS_USB=PA11,PA12",
+      ]
+    lines += ['========= Last MCU build config =========']
+    lines += KCONFIG.splitlines()
+    lines += ['=======================']
+    return lines
+
+  def stats_line(self, state):
+    r = self.rand
+    self.eventtime += 1.
+    parts = [f'Stats {self.eventtime:.1f}: gcodein=0 ']
+    for mcu in self.mcus:
+      s = state.setdefault(mcu, {'write': 0, 'read': 0, 'seq': 0, 'freq': r.randint(71999000, 72001000)})
+      s['write'] += r.randint(100, 5000)
+      s['read'] += r.randint(100, 5000)
+      s['seq'] += r.randint(10, 200)
+      freq = s['freq'] + r.randint(-50, 50)
+      parts += [f'{mcu}: mcu_awake=0.{r.randint(1, 20):03d} mcu_task_avg=0.0000{r.randint(10, 99)} mcu_task_stddev=0.0000{r.randint(10, 99)}'
+                f" bytes_write={s['write']} bytes_read={s['read']} bytes_retransmit=9 bytes_invalid=0 send_seq={s['seq']}"
+                f" receive_seq={s['seq']} retransmit_seq=2 srtt=0.001 rttvar=0.000 rto=0.025 ready_bytes=0 upcoming_bytes=0 freq={freq}"]
+    for heater in self.heaters[1:]:
+      parts += [f'{heater.split()[-1]}: target=60 temp={r.uniform(58., 62.):.1f} pwm={r.random():.3f}']
+    print_time = self.eventtime - 90. + r.random()
+    parts += [f'sysload={r.uniform(0., 2.):.2f} cputime={self.eventtime / 10.:.3f} memavail={r.randint(300000, 800000)}'
+              f' print_time={print_time:.3f} buffer_time={r.uniform(0., 2.5):.3f} print_stall=0']
+    parts += [f'{self.heaters[0]}: target=210 temp={r.uniform(205., 215.):.1f} pwm={r.random():.3f}']
+    return ' '.join(parts)
+
+  def dump_queues(self):
+    r = self.rand
+    lines = ['Dumping serial stats: bytes_write=12345 bytes_read=23456 bytes_retransmit=9 bytes_invalid=0', 'Dumping send queue 100 messages']
+    for n in range(100):
+      lines += [f'Sent {n} {self.eventtime:.6f} {self.eventtime:.6f} 25: seq: 1{n % 16:x}, queue_step oid=4 interval={r.randint(1000, 90000)} count={r.randint(1, 50)} add=0']
+    lines += ['Dumping receive queue 100 messages']
+    for n in range(100):
+      lines += [f'Receive: {n} {self.eventtime:.6f} {self.eventtime:.6f} 11: seq: 1{n % 16:x}, clock clock={r.getrandbits(32)}']
+    return lines
+
+  def session(self, stats):
+    r = self.rand
+    lines = self.session_header()
+    state = {}
+    printing = False
+    for n in range(stats):
+      lines += [self.stats_line(state)]
+      if n % 500 == 250 and not printing:
+        lines += ['Starting SD card print (position 0)']
+        printing = True
+      elif n % 500 == 490 and printing:
+        lines += ['Finished SD card print', 'Exiting SD card print (position 1234567)']
+        printing = False
+      elif n % 97 == 13:
+        lines += [f'; layer {n // 97}', 'toolhead: max_accel=3000.000000 square_corner_velocity=5.000000']
+      elif n % 211 == 101:
+        lines += [f'webhooks client {r.getrandbits(40)}: New connection', f'webhooks client {r.getrandbits(40)}: Client info {{}}']
+    if r.random() < 0.5:
+      lines += [f"Timeout with MCU '{self.mcus[-1]}' (eventtime={self.eventtime:.6f})",
+                "Transition to shutdown state: Lost communication with MCU 'mcu'"]
+      lines += self.dump_queues()
+      lines += [f"MCU '{self.mcus[0]}' shutdown: Timer too close",
+                'This often indicates the host computer is overloaded.',
+                f'Timer too close at shutdown time {self.eventtime - 90.:.6f}s (clock {r.getrandbits(32)} 0)']
+    else:
+      lines += TRACEBACK.splitlines()
+    lines += ['Restarting printer']
+    self.date += datetime.timedelta(seconds=stats + 60)
+    self.eventtime += 60.
+    return lines
+
+  def write(self, filename, size, stats_per_session=2000):
+    written = 0
+    with open(filename, 'w') as f:
+      while written < size:
+        data = '\n'.join(self.session(stats_per_session)) + '\n'
+        f.write(data)
+        written += len(data)
+    return written
+
+
+def synth_chart_data(samples, mcus=2, seed=0):
+  r = random.Random(seed)
+  mcu_names = ['mcu'] + [f'mcu{n}' for n in range(1, mcus)]
+  keys = ['date', 'sampletime']
+  for mcu in mcu_names:
+    keys += [f'{mcu}:{k}' for k in ('mcu_task_avg', 'mcu_task_stddev', 'bytes_write', 'bytes_retransmit', 'freq')]
+  keys += [f'sysinfo:{k}' for k in ('sysload', 'cputime', 'memavail', 'print_time', 'buffer_time', 'print_stall', 'cpudelta')]
+
+  data = []
+  bytes_write = { mcu: 0 for mcu in mcu_names }
+  for n in range(samples):
+    item = { 'sampletime': float(n), 'date': 1683547200000 + n * 1000 }
+    for mcu in mcu_names:
+      bytes_write[mcu] += r.randint(100, 5000)
+      item[f'{mcu}:mcu_task_avg'] = r.uniform(0.00001, 0.0001)
+      item[f'{mcu}:mcu_task_stddev'] = r.uniform(0.00001, 0.0001)
+      item[f'{mcu}:bytes_write'] = float(bytes_write[mcu])
+      item[f'{mcu}:bytes_retransmit'] = 9.
+      item[f'{mcu}:freq'] = float(r.randint(71999000, 72001000))
+    item['sysinfo:sysload'] = r.uniform(0., 200.)
+    item['sysinfo:cputime'] = n / 10.
+    item['sysinfo:memavail'] = r.uniform(300., 800.)
+    item['sysinfo:print_time'] = n + 10.
+    item['sysinfo:buffer_time'] = r.uniform(0., 2.5)
+    item['sysinfo:print_stall'] = 0.
+    item['sysinfo:cpudelta'] = 10.
+    data += [item]
+  return keys, data
+
+
+def peak_rss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_process_logfile(root, logfile):
+  from server import process_logfile
+  os.chdir(root)
+  name = os.path.basename(logfile).split('.')[0]
+  htmlfile = f'cache/{name}.html'
+  start = time.perf_counter()
+  process_logfile(name, htmlfile)
+  elapsed = time.perf_counter() - start
+  return elapsed, os.path.getsize(htmlfile)
+
+def bench_mcu_chart(samples, mcus):
+  import server
+  keys, data = synth_chart_data(samples, mcus)
+  mcu_keys = [ k for k in keys if k.split(':')[-1] in ('bytes_write', 'bytes_retransmit', 'mcu_task_avg', 'mcu_task_stddev') ]
+  start = time.perf_counter()
+  ctx = server.RenderContext()
+  payload = server.new_chart_data(ctx)
+  res = server.add_mcu_chart(ctx, payload, mcu_keys, data)
+  res = server.add_chart_data(ctx, payload) + res
+  return time.perf_counter() - start, len(res)
+
+def bench_freqs_chart(samples, mcus):
+  import server
+  keys, data = synth_chart_data(samples, mcus)
+  freq_keys = [ k for k in keys if k.split(':')[-1] in ('date', 'freq', 'adj') ]
+  start = time.perf_counter()
+  ctx = server.RenderContext()
+  payload = server.new_chart_data(ctx)
+  res = server.add_freqs_chart(ctx, payload, freq_keys[1:], data)
+  res = server.add_chart_data(ctx, payload) + res
+  return time.perf_counter() - start, len(res)
+
+def bench_print_config(repeat):
+  from print_config import print_config
+  size = 0
+  start = time.perf_counter()
+  for n in range(repeat):
+    size += sum(len(l) for l in print_config(KCONFIG))
+  return time.perf_counter() - start, size
+
+def bench_upload_log(root, logfile):
+  from aiohttp import web, FormData
+  from aiohttp.test_utils import TestServer, TestClient
+  import server
+
+  os.chdir(root)
+  os.makedirs('cache', exist_ok=True)
+
+  async def upload():
+    app = web.Application()
+    app.add_routes([web.post('/upload', server.upload_log)])
+    # the upload is queued for rendering like on the server, without render
+    # workers taking it so only the upload itself is measured
+    server.render_scheduler = server.RenderScheduler(server.RENDER_WORKERS)
+    async with TestClient(TestServer(app)) as client:
+      with open(logfile, 'rb') as f:
+        form = FormData()
+        form.add_field('logfile', f, filename='klippy.log')
+        start = time.perf_counter()
+        resp = await client.post('/upload', data=form, allow_redirects=False)
+        elapsed = time.perf_counter() - start
+      if resp.status != 302:
+        raise RuntimeError(f'upload failed with {resp.status}: {await resp.text()}')
+      return elapsed, len(await resp.read())
+
+  return asyncio.run(upload())
+
+def run_phase(func, *args):
+  base = peak_rss()
+  try:
+    elapsed, output = func(*args)
+    error = ''
+  except Exception as e:
+    elapsed = output = 0
+    error = f'{type(e).__name__}: {e}'
+  return elapsed, output, base, peak_rss(), error
+
+def isolated(func, *args):
+  ctx = multiprocessing.get_context('spawn')
+  with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+    return pool.submit(run_phase, func, *args).result()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Klipper log parser benchmarks')
+  parser.add_argument('--size', type=float, default=20., help='synthetic klippy.log size in MB (default: 20)')
+  parser.add_argument('--mcus', type=int, default=2, help='number of MCUs in Stats lines (default: 2)')
+  parser.add_argument('--heaters', type=int, default=2, help='number of heaters in Stats lines (default: 2)')
+  parser.add_argument('--samples', type=int, default=50000, help='samples for standalone chart benchmarks (default: 50000)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--log', help='benchmark an existing klippy.log instead of a synthetic one')
+  parser.add_argument('--generate', metavar='FILE', help='only write a synthetic klippy.log to FILE')
+  parser.add_argument('--json', metavar='FILE', help='write results as json')
+  parser.add_argument('--compare', metavar='FILE', help='compare against previous json results')
+  parser.add_argument('--threshold', type=float, default=0.15, help='allowed slowdown for --compare (default: 0.15)')
+  args = parser.parse_args(argv)
+
+  size = int(args.size * 1024 * 1024)
+  generator = LogGenerator(args.mcus, args.heaters, args.seed)
+
+  if args.generate:
+    written = generator.write(args.generate, size)
+    print(f'written {args.generate} ({written / 1048576.:.1f}MB)')
+    return 0
+
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+  with tempfile.TemporaryDirectory() as root:
+    os.makedirs(os.path.join(root, 'cache'))
+    logfile = os.path.join(root, 'cache', 'bench.log')
+    if args.log:
+      with open(args.log, 'rb') as fin, open(logfile, 'wb') as fout:
+        fout.write(fin.read())
+    else:
+      generator.write(logfile, size)
+
+    logsize = os.path.getsize(logfile)
+    with open(logfile, 'rb') as f:
+      lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024 * 1024), b''))
+
+    print(f'klippy.log: {logsize / 1048576.:.1f}MB, {lines} lines, {args.mcus} mcus, {args.heaters} heaters')
+
+    phases = [
+      ('process_logfile', lines, bench_process_logfile, root, logfile),
+      ('add_mcu_chart', args.samples, bench_mcu_chart, args.samples, args.mcus),
+      ('add_freqs_chart', args.samples, bench_freqs_chart, args.samples, args.mcus),
+      ('print_config', 10, bench_print_config, 10),
+      ('upload_log', lines, bench_upload_log, root, logfile),
+    ]
+
+    results = {}
+    print(f'{"phase":<16} {"seconds":>9} {"items/s":>12} {"peak RSS":>10} {"output":>10}')
+    for name, items, func, *fargs in phases:
+      elapsed, output, base, peak, error = isolated(func, *fargs)
+      if error:
+        print(f'{name:<16} skipped: {error}')
+        continue
+      rate = items / elapsed if elapsed else 0.
+      results[name] = { 'seconds': elapsed, 'rate': rate, 'peak_rss': peak, 'rss_delta': peak - base, 'output_bytes': output }
+      print(f'{name:<16} {elapsed:9.3f} {rate:12.0f} {peak / 1048576.:9.1f}M {output / 1048576.:9.2f}M')
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({ 'size': logsize, 'lines': lines, 'mcus': args.mcus, 'heaters': args.heaters, 'results': results }, f, indent=2)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)['results']
+    regressions = 0
+    for name in results:
+      if not name in baseline:
+        continue
+      old = baseline[name]['seconds']
+      new = results[name]['seconds']
+      change = (new - old) / old if old else 0.
+      mark = 'REGRESSION' if change > args.threshold else 'ok'
+      if change > args.threshold:
+        regressions += 1
+      print(f'{name:<16} {old:9.3f} -> {new:9.3f} ({change * 100.:+.1f}%) {mark}')
+    return 1 if regressions else 0
+
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import time
+import json
+import logging
+import sqlite3
+from contextlib import contextmanager
+
+import storage
+
+
+CATALOG_DB = 'cache/catalog.db'
+
+COMPANIONS = ('moonraker', 'dmesg', 'debug', 'crownest', 'telegram')
+
+COLUMNS = ('digest', 'size', 'mtime') + COMPANIONS + ('html_size',)
+
+initialized = False
+
+
+def connect():
+  db = sqlite3.connect(CATALOG_DB, timeout=30)
+  db.row_factory = sqlite3.Row
+  db.execute('PRAGMA journal_mode=WAL')
+  return db
+
+@contextmanager
+def transaction():
+  db = connect()
+  try:
+    with db:
+      yield db
+  finally:
+    db.close()
+
+def init():
+  global initialized
+  if initialized:
+    return
+
+  with transaction() as db:
+    # companion columns hold the file size, NULL when the file was not uploaded
+    db.execute(f'''CREATE TABLE IF NOT EXISTS uploads (
+  digest TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  {', '.join(f'{c} INTEGER' for c in COMPANIONS)},
+  html_size INTEGER,
+  rendered REAL,
+  summary TEXT,
+  accessed REAL
+)''')
+    db.execute('CREATE INDEX IF NOT EXISTS uploads_mtime ON uploads (mtime)')
+    db.execute('CREATE INDEX IF NOT EXISTS uploads_accessed ON uploads (accessed)')
+  initialized = True
+
+def is_digest(name):
+  # uploads are stored under the md5 hex digest of klippy.log
+  return len(name) == 32 and all(c in '0123456789abcdef' for c in name)
+
+def probe(digest, objects=None):
+  # stored state of one digest, objects is an optional storage listing
+  def stat(name):
+    if objects is not None:
+      return objects.get(name)
+    return storage.get().stat(name)
+
+  def size(name):
+    st = stat(name)
+    return st[0] if st is not None else None
+
+  log = stat(f'{digest}.log')
+  if log is None:
+    return None
+
+  row = [digest, log[0], log[1]]
+  row += [size(f'{digest}_{c}.log') for c in COMPANIONS]
+  row += [size(f'{digest}.html')]
+  return row
+
+UPSERT = f'''INSERT INTO uploads ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})
+ON CONFLICT (digest) DO UPDATE SET
+  {', '.join(f'{c} = excluded.{c}' for c in COLUMNS[1:])},
+  rendered = CASE WHEN excluded.html_size IS NULL THEN NULL ELSE rendered END'''
+
+def add(digest):
+  # records the files stored for digest, returns the catalog entry or None
+  init()
+  row = probe(digest)
+  if row is None:
+    return None
+
+  with transaction() as db:
+    db.execute(UPSERT, row)
+    return fetch(db, digest)
+
+def sync():
+  # brings the catalog in line with the stored logs, run once at startup
+  init()
+  start = time.perf_counter()
+  objects = storage.get().listing()
+  digests = [f[:-4] for f in objects if f.endswith('.log') and not '_' in f]
+  rows = [probe(digest, objects) for digest in digests]
+
+  with transaction() as db:
+    db.execute('CREATE TEMP TABLE present (digest TEXT PRIMARY KEY)')
+    db.executemany('INSERT INTO present VALUES (?)', ((d,) for d in digests))
+    removed = db.execute('DELETE FROM uploads WHERE digest NOT IN (SELECT digest FROM present)').rowcount
+    db.executemany(UPSERT, rows)
+
+  logging.info('catalog synced %d uploads, removed %d in %.2fs\n', len(rows), removed, time.perf_counter() - start)
+  return len(rows)
+
+def fetch(db, digest):
+  row = db.execute('SELECT * FROM uploads WHERE digest = ?', (digest,)).fetchone()
+  return dict(row) if row else None
+
+def get(digest):
+  init()
+  with transaction() as db:
+    return fetch(db, digest)
+
+def listing(limit=-1, offset=0):
+  init()
+  with transaction() as db:
+    return [dict(row) for row in db.execute(f'SELECT {", ".join(COLUMNS)}, rendered, accessed FROM uploads ORDER BY mtime DESC LIMIT ? OFFSET ?', (limit, offset))]
+
+def rendered(digest, html_size, summary):
+  init()
+  with transaction() as db:
+    db.execute('UPDATE uploads SET html_size = ?, rendered = ?, summary = ? WHERE digest = ?',
+               (html_size, time.time(), json.dumps(summary) if summary is not None else None, digest))
+
+def touch(digest):
+  init()
+  with transaction() as db:
+    db.execute('UPDATE uploads SET accessed = ? WHERE digest = ?', (time.time(), digest))
+
+def expired(days):
+  # digests neither uploaded nor viewed in the last days
+  init()
+  cutoff = time.time() - days * 86400
+  with transaction() as db:
+    return [row[0] for row in db.execute('SELECT digest FROM uploads WHERE max(mtime, coalesce(accessed, 0)) < ? ORDER BY mtime', (cutoff,))]
+
+def remove(digest):
+  init()
+  with transaction() as db:
+    db.execute('DELETE FROM uploads WHERE digest = ?', (digest,))
+
+def summaries(since=0):
+  # (digest, rendered, summary) of uploads rendered after since
+  init()
+  with transaction() as db:
+    return [(row[0], row[1], json.loads(row[2])) for row in db.execute('SELECT digest, rendered, summary FROM uploads WHERE summary IS NOT NULL AND rendered > ?', (since,))]
+
+def summarized():
+  init()
+  with transaction() as db:
+    return {row[0] for row in db.execute('SELECT digest FROM uploads WHERE summary IS NOT NULL')}
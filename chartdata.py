@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import base64
+from array import array
+
+
+INT32_MAX = 2 ** 31 - 1
+NAN = float('nan')
+
+
+class ChartPayload:
+  # Chart samples of one part of a page in columns instead of a list of
+  # objects repeating every key. Each table holds the sample dates as Int32
+  # milliseconds after its first sample, then one Float32 column per key
+  # with NaN where a sample has no value. decodeCharts() in the page turns
+  # the tables back into the row objects the charts take.
+
+  def __init__(self):
+    self.keys = []
+    self.key_ids = {}
+    self.tables = []
+    self.chunks = []
+    self.size = 0
+
+  def key_id(self, key):
+    if not key in self.key_ids:
+      self.key_ids[key] = len(self.keys)
+      self.keys += [key]
+    return self.key_ids[key]
+
+  def append(self, values):
+    if sys.byteorder == 'big':
+      values.byteswap()
+    data = values.tobytes()
+    self.chunks += [data]
+    self.size += len(data)
+
+  def add_table(self, dates, columns):
+    # dates of the samples and {key: values} with None for missing values,
+    # returns the index of the table in the decoded payload
+    base = dates[0] if dates else 0
+    offsets = [date - base for date in dates]
+    # dates more than 24 days apart do not fit Int32, these go as Float64
+    wide = bool(offsets) and max(abs(min(offsets)), abs(max(offsets))) > INT32_MAX
+    if wide:
+      if self.size % 8:
+        self.append(array('i', [0]))
+      self.append(array('d', offsets))
+    else:
+      self.append(array('i', offsets))
+
+    ids = []
+    for key, values in columns.items():
+      ids += [self.key_id(key)]
+      self.append(array('f', [NAN if v is None else v for v in values]))
+
+    self.tables += [{'rows': len(dates), 'date': base, 'wide': wide, 'columns': ids}]
+    return len(self.tables) - 1
+
+  def add_rows(self, rows, keys):
+    # table of the keys of sample dicts, each holding at least 'date'
+    return self.add_table([row['date'] for row in rows], {key: [row.get(key) for row in rows] for key in keys})
+
+  def script(self):
+    # javascript expression evaluating to the list of decoded tables
+    header = json.dumps({'keys': self.keys, 'tables': self.tables}, separators=(',', ':')).replace('</', '<\\/')
+    data = base64.b64encode(b''.join(self.chunks)).decode()
+    return f'decodeCharts({header}, "{data}")'
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from collections import OrderedDict
+
+
+# bytes of responses kept in memory by a server process, and the largest
+# single response kept
+HOT_CACHE_MAX = 1024 * 1024 * 256
+HOT_ITEM_MAX = 1024 * 1024 * 32
+
+# a file is kept in memory once it was requested this many times within
+# HOT_WINDOW seconds, pages viewed once do not push out shared ones
+HOT_REQUESTS = 2
+HOT_WINDOW = 600
+SEEN_MAX = 4096
+
+
+def file_etag(st):
+  # the strong etag aiohttp's FileResponse sends for the same file
+  return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+class HotEntry:
+  def __init__(self, body, etag, mtime, version=None):
+    self.body = body
+    self.etag = etag
+    self.mtime = mtime
+    self.version = version
+
+
+def read_entry(filename, version=None):
+  with open(filename, 'rb') as f:
+    st = os.fstat(f.fileno())
+    return HotEntry(f.read(), file_etag(st), st.st_mtime, version)
+
+
+class HotCache:
+  # LRU of file contents by storage name. An entry is only returned for the
+  # version it was read at, pages are stored with their render time so a
+  # page rendered again by another process is read again, logs with their
+  # upload time so a log expired and uploaded again is read again.
+
+  def __init__(self, max_bytes=HOT_CACHE_MAX, item_max=HOT_ITEM_MAX):
+    self.max_bytes = max_bytes
+    self.item_max = item_max
+    self.entries = OrderedDict()
+    self.seen = OrderedDict()
+    self.size = 0
+
+  def get(self, name, version=None):
+    entry = self.entries.get(name)
+    if entry is None:
+      return None
+    if entry.version != version:
+      self.discard(name)
+      return None
+    self.entries.move_to_end(name)
+    return entry
+
+  def hot(self, name, size):
+    # counts a request served from the file, True once it should be kept
+    if size > self.item_max:
+      return False
+    now = time.monotonic()
+    first, count = self.seen.pop(name, (now, 0))
+    if now - first > HOT_WINDOW:
+      first, count = now, 0
+    self.seen[name] = (first, count + 1)
+    while len(self.seen) > SEEN_MAX:
+      self.seen.popitem(last=False)
+    return count + 1 >= HOT_REQUESTS
+
+  def put(self, name, entry):
+    self.discard(name)
+    self.seen.pop(name, None)
+    self.entries[name] = entry
+    self.size += len(entry.body)
+    while self.size > self.max_bytes:
+      _, old = self.entries.popitem(last=False)
+      self.size -= len(old.body)
+
+  def discard(self, name):
+    entry = self.entries.pop(name, None)
+    if entry is not None:
+      self.size -= len(entry.body)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import os
+import fcntl
+from contextlib import contextmanager
+
+
+# Advisory file locks shared by the server processes started by run(), the
+# lock files are left in place, taking them is what counts. remove_lock
+# drops a lock file nobody holds, a process that was waiting on it sees the
+# file is gone and takes the lock on a new one.
+
+def same_file(f, filename):
+  try:
+    return os.fstat(f.fileno()).st_ino == os.stat(filename).st_ino
+  except FileNotFoundError:
+    return False
+
+@contextmanager
+def file_lock(filename):
+  # waits for the lock
+  while True:
+    with open(filename, 'a') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      if not same_file(f, filename):
+        continue
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+      return
+
+def try_lock(filename):
+  # returns an open file holding the lock until it is closed, or None if
+  # another process has it
+  while True:
+    f = open(filename, 'a')
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      f.close()
+      return None
+    if same_file(f, filename):
+      return f
+    f.close()
+
+def remove_lock(filename):
+  # removes the lock file unless another process holds the lock, True if
+  # it was removed
+  lock = try_lock(filename)
+  if lock is None:
+    return False
+  with lock:
+    os.remove(filename)
+  return True
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+from mmap import mmap, ACCESS_READ
+from contextlib import contextmanager
+
+
+def map_file(f):
+  # read-only mmap of an open binary file, or empty bytes for empty files
+  if os.fstat(f.fileno()).st_size == 0:
+    return b''
+  return mmap(f.fileno(), 0, access=ACCESS_READ)
+
+@contextmanager
+def open_mmap(filename):
+  with open(filename, 'rb') as f:
+    mm = map_file(f)
+    try:
+      yield mm
+    finally:
+      if mm:
+        mm.close()
+
+def iter_lines(mm, start=0):
+  # mmap.readline finds each line end with memchr in C; lines keep their
+  # trailing newline like iterating over a binary file
+  if not mm:
+    return iter(())
+  mm.seek(start)
+  return iter(mm.readline, b'')
+
+def iter_range(mm, start, end):
+  # lines starting at byte offsets start..end, the line at end included
+  mm.seek(start)
+  readline = mm.readline
+  while mm.tell() <= end:
+    line = readline()
+    if not line:
+      break
+    yield line
+
+def line_starts(mm, prefix):
+  # byte offsets of the lines starting with prefix, in file order
+  if mm[:len(prefix)] == prefix:
+    yield 0
+  marker = b'\n' + prefix
+  pos = mm.find(marker)
+  while pos >= 0:
+    yield pos + 1
+    pos = mm.find(marker, pos + 1)
+
+def find_all(mm, marker):
+  # byte offsets of the lines containing marker, in file order
+  pos = mm.find(marker)
+  while pos >= 0:
+    start = mm.rfind(b'\n', 0, pos) + 1
+    yield start
+    end = mm.find(b'\n', pos)
+    if end < 0:
+      break
+    pos = mm.find(marker, end)
+
+def line_at(mm, pos):
+  # returns the line (without newline) containing byte offset pos
+  start = mm.rfind(b'\n', 0, pos) + 1
+  end = mm.find(b'\n', pos)
+  if end < 0:
+    end = len(mm)
+  return mm[start:end]
+
+def last_line_with(mm, marker, end=None):
+  # scans backwards from end and stops at the last line containing marker
+  pos = mm.rfind(marker, 0, len(mm) if end is None else end)
+  if pos < 0:
+    return None
+  return line_at(mm, pos)
+
+def tail_start(mm, count):
+  # byte offset of the last count lines, scanning back from the end so only
+  # the pages holding them are read
+  end = len(mm)
+  if count <= 0:
+    return end
+  if end and mm[end - 1:end] == b'\n':
+    end -= 1
+  for _ in range(count):
+    end = mm.rfind(b'\n', 0, end)
+    if end < 0:
+      return 0
+  return end + 1
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+
+class KeywordMatcher:
+  # One compiled alternation for all keywords of all categories, so a line is
+  # scanned once no matter how many keywords or categories there are.
+
+  def __init__(self, **categories):
+    self.categories = {}
+    for category, keywords in categories.items():
+      for keyword in keywords:
+        self.categories.setdefault(keyword, set()).add(category)
+
+    keywords = sorted(self.categories, key=len, reverse=True)
+    self.regex = re.compile('|'.join(re.escape(k) for k in keywords)) if keywords else None
+    self.bregex = re.compile(b'|'.join(re.escape(k.encode()) for k in keywords)) if keywords else None
+    self.empty = frozenset()
+
+  def match(self, line):
+    if self.regex is None:
+      return self.empty
+
+    m = self.regex.search(line)
+    if m is None:
+      return self.empty
+
+    found = set(self.categories[m.group()])
+    for m in self.regex.finditer(line, m.end()):
+      found |= self.categories[m.group()]
+    return found
+
+  def scan(self, buf):
+    # yields (line, categories) for each line of a bytes buffer or mmap that
+    # contains a keyword, without splitting the buffer into lines first
+    if self.bregex is None:
+      return
+
+    pos = 0
+    while True:
+      m = self.bregex.search(buf, pos)
+      if m is None:
+        return
+      start = buf.rfind(b'\n', 0, m.start()) + 1
+      end = buf.find(b'\n', m.end())
+      if end < 0:
+        end = len(buf)
+      line = buf[start:end].decode(errors='replace')
+      yield line, self.match(line)
+      pos = end + 1
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import functools
+from time import perf_counter
+
+
+registry = []
+
+_lock = threading.RLock()
+
+INF = float('inf')
+
+
+def format_labels(names, values, extra=None):
+  pairs = list(zip(names, values))
+  if extra:
+    pairs += [extra]
+  if not pairs:
+    return ''
+  inner = ','.join(f'{k}="{str(v)}"' for k, v in pairs)
+  return '{' + inner + '}'
+
+def format_value(value):
+  if value == INF:
+    return '+Inf'
+  if float(value).is_integer() and abs(value) < 1e15:
+    return str(int(value))
+  return repr(float(value))
+
+
+class Metric:
+  kind = 'untyped'
+
+  def __init__(self, name, doc, labels=()):
+    self.name = name
+    self.doc = doc
+    self.labels = tuple(labels)
+    self.values = {}
+    if not self.labels and self.kind in ('counter', 'gauge'):
+      self.values[()] = 0.
+    registry.append(self)
+
+  def key(self, labels):
+    return tuple(labels.get(l, '') for l in self.labels)
+
+  def samples(self):
+    return [ (self.name, key, None, value) for key, value in self.values.items() ]
+
+  def expose(self):
+    lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+    for name, key, extra, value in self.samples():
+      lines += [f'{name}{format_labels(self.labels, key, extra)} {format_value(value)}']
+    return lines
+
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1., **labels):
+    key = self.key(labels)
+    with _lock:
+      self.values[key] = self.values.get(key, 0.) + amount
+
+
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def __init__(self, name, doc, labels=(), func=None):
+    # func is called on every scrape and returns a value or a {labelvalues: value} dict
+    super().__init__(name, doc, labels)
+    self.func = func
+
+  def set(self, value, **labels):
+    with _lock:
+      self.values[self.key(labels)] = value
+
+  def inc(self, amount=1., **labels):
+    key = self.key(labels)
+    with _lock:
+      self.values[key] = self.values.get(key, 0.) + amount
+
+  def dec(self, amount=1., **labels):
+    self.inc(-amount, **labels)
+
+  def samples(self):
+    if self.func:
+      values = self.func()
+      if not isinstance(values, dict):
+        values = { (): values }
+      return [ (self.name, key, None, value) for key, value in values.items() ]
+    return super().samples()
+
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, doc, buckets, labels=()):
+    super().__init__(name, doc, labels)
+    self.buckets = tuple(sorted(buckets)) + (INF,)
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    with _lock:
+      counts, total, n = self.values.get(key) or ([0] * len(self.buckets), 0., 0)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      self.values[key] = (counts, total + value, n + 1)
+
+  def samples(self):
+    res = []
+    for key, (counts, total, n) in self.values.items():
+      cumulative = 0
+      for bound, count in zip(self.buckets, counts):
+        cumulative += count
+        res += [(f'{self.name}_bucket', key, ('le', format_value(bound)), cumulative)]
+      res += [(f'{self.name}_sum', key, None, total), (f'{self.name}_count', key, None, n)]
+    return res
+
+
+def timed(histogram, **labels):
+  def decorator(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+      start = perf_counter()
+      try:
+        return await func(*args, **kwargs)
+      finally:
+        histogram.observe(perf_counter() - start, **labels)
+    return wrapper
+  return decorator
+
+def expose():
+  lines = []
+  with _lock:
+    for metric in registry:
+      lines += metric.expose()
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import logging
+
+import cProfile
+import pstats
+
+from time import perf_counter
+
+from metrics import Counter
+
+
+PROFILE_ENV = 'KLIPPER_LOGS_PROFILE'
+
+render_phase_seconds = Counter('klipper_logs_render_phase_seconds_total', 'Time spent in each render phase of profiled renders', ('phase',))
+render_phase_events = Counter('klipper_logs_render_events_total', 'Items counted during profiled renders', ('event',))
+render_profiled = Counter('klipper_logs_render_profiled_total', 'Number of profiled renders')
+
+# (phases, counters) of the last profiled render in this process, a render
+# worker hands it back to the server with its result
+last_profile = None
+
+
+def parse_mode(value):
+  # 'timers' enables phase timers, 'cprofile' adds a cProfile dump, anything
+  # else disables profiling
+  if value in ('1', 'true', 'yes', 'timers'):
+    return 'timers'
+  if value == 'cprofile':
+    return 'cprofile'
+  return ''
+
+def profile_mode(flag=''):
+  return parse_mode(flag or os.environ.get(PROFILE_ENV, ''))
+
+def request_profile(value):
+  # ?profile= of a page request, only honoured when the server was started
+  # with KLIPPER_LOGS_PROFILE set, 'request' allows it without profiling
+  # every render
+  env = os.environ.get(PROFILE_ENV, '')
+  if env != 'request' and not parse_mode(env):
+    return ''
+  return parse_mode(value)
+
+
+class RenderTimer:
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.phases = {}
+    self.counters = {}
+    self.start = perf_counter()
+
+  def add(self, phase, start):
+    now = perf_counter()
+    self.phases[phase] = self.phases.get(phase, 0.) + now - start
+    return now
+
+  def count(self, name, value=1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def remainder(self, phase, start, inner=()):
+    # time since start that is not accounted for by the inner phases
+    elapsed = perf_counter() - start
+    self.phases[phase] = max(0., elapsed - sum(self.phases.get(p, 0.) for p in inner))
+
+  def finish(self, digest):
+    if not self.enabled:
+      return
+
+    self.phases['total'] = perf_counter() - self.start
+
+    phases = ' '.join(f'{k}={v:.3f}s' for k, v in self.phases.items())
+    counters = ' '.join(f'{k}={v}' for k, v in self.counters.items())
+    logging.info('render profile %s: %s %s\n', digest, phases, counters)
+
+    global last_profile
+    last_profile = (self.phases, self.counters)
+
+
+def take_profile():
+  # profile of the last render in this process, once
+  global last_profile
+  profile, last_profile = last_profile, None
+  return profile
+
+def record_profile(profile):
+  # adds the profile of a render, possibly done in another process, to the
+  # metrics of this one
+  phases, counters = profile
+  for phase, seconds in phases.items():
+    render_phase_seconds.inc(seconds, phase=phase)
+  for event, value in counters.items():
+    render_phase_events.inc(value, event=event)
+  render_profiled.inc()
+
+
+def run_cprofile(statsfile, func, *args, **kwargs):
+  profiler = cProfile.Profile()
+  logging.info('cprofile render in pid %d to %s\n', os.getpid(), statsfile)
+  try:
+    return profiler.runcall(func, *args, **kwargs)
+  finally:
+    profiler.dump_stats(statsfile)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+    logging.info('cprofile top functions:\n%s', stream.getvalue())
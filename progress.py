@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+
+
+# seconds between progress file writes while a render is running
+PROGRESS_INTERVAL = 0.5
+
+
+def progress_file(digest, segment=None):
+  if segment is None:
+    return f'cache/{digest}.progress'
+  return f'cache/{digest}.seg{segment}.progress'
+
+
+class Progress:
+  # Progress of one render or render segment. Renders run in worker
+  # processes, so the state goes through a small file the server reads.
+
+  def __init__(self, digest, total, segment=None, start=0):
+    self.filename = progress_file(digest, segment)
+    self.total = total
+    self.start = start
+    self.started = time.time()
+    self.written = 0
+
+  def tick(self, pos, lines):
+    # cheap enough to call every few thousand lines
+    if time.time() - self.written >= PROGRESS_INTERVAL:
+      self.update(pos, lines)
+
+  def update(self, pos, lines, **extra):
+    state = { 'done': pos - self.start, 'total': self.total, 'lines': lines, 'started': self.started, 'updated': time.time() }
+    state.update(extra)
+    tempname = f'{self.filename}.tmp'
+    with open(tempname, 'w') as f:
+      json.dump(state, f)
+    os.replace(tempname, self.filename)
+    self.written = state['updated']
+
+  def remove(self):
+    remove(self.filename)
+
+
+def remove(filename):
+  if os.path.exists(filename):
+    os.remove(filename)
+
+def load(filename):
+  try:
+    with open(filename) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def read(digest):
+  # progress of a running render of digest with the parts of a render in
+  # segments summed up, None if there is none
+  state = load(progress_file(digest))
+  if state is None:
+    return None
+
+  segments = state.get('segments')
+  if segments:
+    parts = [load(progress_file(digest, k)) or {'done': 0, 'total': 0, 'lines': 0} for k in range(segments)]
+    state['done'] = sum(p['done'] for p in parts)
+    state['lines'] = sum(p['lines'] for p in parts)
+    state['parts'] = [{'done': p['done'], 'total': p['total']} for p in parts]
+
+  elapsed = max(time.time() - state['started'], 0.001)
+  state['lines_per_second'] = round(state['lines'] / elapsed)
+  state['percent'] = round(100. * state['done'] / state['total'], 1) if state['total'] else 0.
+  return state
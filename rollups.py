@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import html
+import logging
+
+import catalog
+from matcher import KeywordMatcher
+
+
+ROLLUPS_FILE = 'cache/rollups.json'
+ROLLUP_INTERVAL = 300
+
+# error classes of the summary error lines, a line can be in several classes
+error_matcher = KeywordMatcher(
+  timer_too_close=('Timer too close',),
+  timeout=('Timeout with MCU', 'Lost communication with MCU'),
+  serial=('Unable to open serial port', 'Unable to connect', 'Got EOF ', 'Got error ', 'serialhdl'),
+  move_queue=('Move queue overflow', 'Rescheduled timer in the past', 'Missed scheduling of next'),
+  heater=('Heater ', 'not heating at expected rate', 'ADC out of range'),
+  stepper=('stepcompress', 'Stepper too far in past', 'Invalid count'),
+  tmc=('TMC ', 'GSTAT', 'DRV_STATUS'),
+  mcu_shutdown=("' shutdown: ", 'Transition to shutdown state'),
+  config=('Option ', 'Section ', 'Unknown pin', 'No such file or directory'),
+)
+
+# config warnings produced by the summary config checks in process_logfile
+warning_matcher = KeywordMatcher(
+  serial_reused=('already used',),
+  serial_template=('template value',),
+  serial_tty=('use serial/by-id',),
+  rotation_distance=('decimal rotation_distance',),
+)
+
+facts = {}
+since = 0
+current = {}
+
+
+def log_facts(summary):
+  # the few fields of a parse summary the rollups are built from
+  errors = set()
+  for e in summary.get('lastErrors', []):
+    found = error_matcher.match(html.unescape(e['text']))
+    errors |= found or {'other'}
+
+  warnings = set()
+  for w in summary.get('lastConfig', []):
+    warnings |= warning_matcher.match(w['text']) or {'other'}
+
+  versions = summary.get('versions', {})
+  return {
+    'errors': sorted(errors),
+    'warnings': sorted(warnings),
+    'git': versions.get('git', ''),
+    'versions': sorted({v for k, v in versions.items() if k != 'git'}),
+    'mcus': sorted(set(summary.get('mcuTypes', {}).values())),
+    'fuckups': summary.get('fuckups', 0),
+    'versions_ok': summary.get('versions_ok', False),
+  }
+
+def count(table, key, value=1):
+  table[key] = table.get(key, 0) + value
+
+def aggregate():
+  errors = {}
+  warnings = {}
+  by_version = {}
+  by_mcu = {}
+  logs_by_version = {}
+  logs_by_mcu = {}
+  restarts = 0
+  restart_logs = 0
+  versions_ok = 0
+
+  for f in facts.values():
+    for e in f['errors']:
+      count(errors, e)
+    for w in f['warnings']:
+      count(warnings, w)
+    for v in f['versions'] or ['unknown']:
+      count(logs_by_version, v)
+      for e in f['errors']:
+        count(by_version.setdefault(v, {}), e)
+    for m in f['mcus'] or ['unknown']:
+      count(logs_by_mcu, m)
+      for e in f['errors']:
+        count(by_mcu.setdefault(m, {}), e)
+    if f['fuckups']:
+      restarts += f['fuckups']
+      restart_logs += 1
+    if f['versions_ok']:
+      versions_ok += 1
+
+  return {
+    'generated': time.time(),
+    'logs': len(facts),
+    'errors': errors,
+    'warnings': warnings,
+    'errors_by_version': by_version,
+    'errors_by_mcu': by_mcu,
+    'logs_by_version': logs_by_version,
+    'logs_by_mcu': logs_by_mcu,
+    'unexpected_restarts': {'logs': restart_logs, 'total': restarts},
+    'versions_ok': versions_ok,
+  }
+
+def load():
+  global current
+  try:
+    with open(ROLLUPS_FILE) as f:
+      current = json.load(f)
+  except (OSError, ValueError):
+    current = {}
+  return current
+
+def refresh():
+  # only summaries rendered since the last refresh are parsed, removed
+  # uploads are dropped, then the rollups are recomputed from the facts
+  global since, current
+  start = time.perf_counter()
+
+  for digest, rendered, summary in catalog.summaries(since):
+    facts[digest] = log_facts(summary)
+    since = max(since, rendered)
+
+  present = catalog.summarized()
+  for digest in [d for d in facts if d not in present]:
+    del facts[digest]
+
+  current = aggregate()
+
+  tempname = f'{ROLLUPS_FILE}.tmp'
+  with open(tempname, 'w') as f:
+    json.dump(current, f)
+  os.replace(tempname, ROLLUPS_FILE)
+
+  logging.info('rollups of %d logs refreshed in %.2fs\n', len(facts), time.perf_counter() - start)
+  return current
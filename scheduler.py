@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+
+QUEUE_MAX = 32
+CLIENT_QUEUE_MAX = 4
+
+# renders waiting longer than this are no longer passed by smaller logs
+STARVATION_SECONDS = 60
+
+# estimated peak memory of a render per byte of klippy.log, and memory left
+# to the rest of the system when a render is started next to others
+MEMORY_PER_BYTE = 4
+MEMORY_RESERVE = 1024 * 1024 * 256
+
+# suggested wait of a rejected client per queued render and worker
+RETRY_SECONDS = 5
+
+
+class QueueFull(Exception):
+  def __init__(self, retry_after):
+    super().__init__(f'render queue is full, retry in {retry_after}s')
+    self.retry_after = retry_after
+
+
+class RenderJob:
+  def __init__(self, digest, size, client, priority, profile, seq):
+    self.digest = digest
+    self.size = size
+    self.client = client
+    self.priority = priority
+    self.profile = profile
+    self.seq = seq
+    self.queued_at = time.monotonic()
+    # resolved with the page size, or None if the render failed
+    self.future = asyncio.get_running_loop().create_future()
+
+
+def available_memory():
+  # MemAvailable of /proc/meminfo in bytes, None where it is not known
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+class RenderScheduler:
+  # Orders queued renders by priority, then by the renders their client
+  # already has running, then smallest log first. A render is started next
+  # to others only if the memory it is estimated to need is available.
+
+  def __init__(self, workers, queue_max=QUEUE_MAX, client_queue_max=CLIENT_QUEUE_MAX):
+    self.workers = workers
+    self.queue_max = queue_max
+    self.client_queue_max = client_queue_max
+    self.queued = {}
+    self.running = {}
+    self.seq = 0
+    self.wakeup = asyncio.Event()
+
+  def get(self, digest):
+    return self.queued.get(digest) or self.running.get(digest)
+
+  def submit(self, digest, size, client, priority, profile=''):
+    # a digest is rendered once, submitting it again can only raise its priority
+    job = self.get(digest)
+    if job is not None:
+      if digest in self.queued and priority < job.priority:
+        job.priority = priority
+        self.wakeup.set()
+      return job
+
+    if len(self.queued) >= self.queue_max or self.client_queued(client) >= self.client_queue_max:
+      raise QueueFull(self.retry_after())
+
+    self.seq += 1
+    job = self.queued[digest] = RenderJob(digest, size, client, priority, profile, self.seq)
+    self.wakeup.set()
+    return job
+
+  def client_queued(self, client):
+    return sum(1 for job in self.queued.values() if job.client == client)
+
+  def client_running(self, client):
+    return sum(1 for job in self.running.values() if job.client == client)
+
+  def starved(self, job, now):
+    return now - job.queued_at > STARVATION_SECONDS
+
+  def order(self, now):
+    # queued jobs in the order they are started
+    running = {}
+    for job in self.running.values():
+      running[job.client] = running.get(job.client, 0) + 1
+    return sorted(self.queued.values(), key=lambda job:
+                  (job.priority, running.get(job.client, 0), 0 if self.starved(job, now) else job.size, job.seq))
+
+  def fits(self, job):
+    if not self.running:
+      return True
+    available = available_memory()
+    if available is None:
+      return True
+    return job.size * MEMORY_PER_BYTE <= available - MEMORY_RESERVE
+
+  def pick(self):
+    if len(self.running) >= self.workers:
+      return None
+    now = time.monotonic()
+    for job in self.order(now):
+      if self.fits(job):
+        return job
+      if self.starved(job, now):
+        # smaller renders must not keep it waiting for memory forever
+        return None
+    return None
+
+  async def next(self):
+    # waits for the next job that can start and marks it running
+    while True:
+      job = self.pick()
+      if job is not None:
+        break
+      self.wakeup.clear()
+      await self.wakeup.wait()
+
+    del self.queued[job.digest]
+    self.running[job.digest] = job
+    return job
+
+  def done(self, job, result):
+    del self.running[job.digest]
+    job.future.set_result(result)
+    self.wakeup.set()
+
+  def position(self, digest):
+    # renders running or queued ahead of digest
+    if digest in self.running:
+      return len(self.running) - 1
+    ahead = 0
+    for job in self.order(time.monotonic()):
+      if job.digest == digest:
+        break
+      ahead += 1
+    return len(self.running) + ahead
+
+  def retry_after(self):
+    return max(1, RETRY_SECONDS * (len(self.queued) + len(self.running)) // self.workers)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import time
+import html
+import logging
+import sqlite3
+
+import catalog
+
+
+SEARCH_DB = 'cache/search.db'
+
+# snippet markers, replaced by <b></b> after the snippet text is escaped
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+available = None
+
+
+def connect():
+  db = sqlite3.connect(SEARCH_DB, timeout=30)
+  db.execute('PRAGMA journal_mode=WAL')
+  return db
+
+def init():
+  global available
+  if available is not None:
+    return available
+
+  try:
+    with connect() as db:
+      db.execute('CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY, digest TEXT UNIQUE, mtime REAL, indexed REAL)')
+      db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5(errors, mcu, versions, config)')
+    available = True
+  except sqlite3.OperationalError as e:
+    logging.warning('full text search disabled: %s\n', e)
+    available = False
+  return available
+
+def index_log(digest, mtime, errors, mcu, versions, config):
+  # one document per digest, so a query can combine columns, for example
+  # errors:"Timeout with MCU" AND config:octopus
+  if not init():
+    return
+
+  try:
+    db = connect()
+    with db:
+      row = db.execute('SELECT id FROM logs WHERE digest = ?', (digest,)).fetchone()
+      if row:
+        db.execute('DELETE FROM logs_fts WHERE rowid = ?', (row[0],))
+        db.execute('UPDATE logs SET mtime = ?, indexed = ? WHERE id = ?', (mtime, time.time(), row[0]))
+        rowid = row[0]
+      else:
+        rowid = db.execute('INSERT INTO logs (digest, mtime, indexed) VALUES (?, ?, ?)', (digest, mtime, time.time())).lastrowid
+      db.execute('INSERT INTO logs_fts (rowid, errors, mcu, versions, config) VALUES (?, ?, ?, ?, ?)',
+                 (rowid, '\n'.join(errors), '\n'.join(mcu), '\n'.join(versions), '\n'.join(config)))
+    db.close()
+  except sqlite3.Error as e:
+    logging.warning('failed to index %s: %s\n', digest, e)
+
+def remove(db, digest):
+  row = db.execute('SELECT id FROM logs WHERE digest = ?', (digest,)).fetchone()
+  if row:
+    db.execute('DELETE FROM logs_fts WHERE rowid = ?', (row[0],))
+    db.execute('DELETE FROM logs WHERE id = ?', (row[0],))
+
+def forget(digest):
+  if not init():
+    return
+
+  db = connect()
+  try:
+    with db:
+      remove(db, digest)
+  finally:
+    db.close()
+
+def phrase(query):
+  return '"' + query.replace('"', '""') + '"'
+
+def format_snippet(snippet):
+  return html.escape(snippet).replace(MARK_START, '<b>').replace(MARK_END, '</b>')
+
+def search(query, days=0, limit=50):
+  if not init():
+    return None
+
+  since = time.time() - days * 86400 if days else 0
+  sql = f'''SELECT l.digest, l.mtime, snippet(logs_fts, -1, '{MARK_START}', '{MARK_END}', '...', 24)
+FROM logs_fts JOIN logs l ON l.id = logs_fts.rowid
+WHERE logs_fts MATCH ? AND l.mtime >= ? ORDER BY l.mtime DESC LIMIT ?'''
+
+  db = connect()
+  try:
+    try:
+      rows = db.execute(sql, (query, since, limit)).fetchall()
+    except sqlite3.OperationalError:
+      # not valid fts5 query syntax, search for the text as a phrase
+      rows = db.execute(sql, (phrase(query), since, limit)).fetchall()
+
+    results = []
+    stale = []
+    for digest, mtime, snippet in rows:
+      if catalog.get(digest) is None:
+        stale += [digest]
+        continue
+      results += [{'digest': digest, 'mtime': mtime, 'snippet': format_snippet(snippet)}]
+
+    if stale:
+      with db:
+        for digest in stale:
+          remove(db, digest)
+  finally:
+    db.close()
+
+  return results
@@ -11,23 +11,62 @@ import hashlib
 from mmap import mmap, ACCESS_READ
 
 import os
+import sys
+import signal
 import datetime
+import asyncio
 
 import random
 import html
 
 import tarfile
+import bisect
+
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+import time
+from time import perf_counter
 
 import gzip
 import shutil
 
 from print_config import print_config
-
-
-chart_n = 0
-chart_data_n = 0
-collapse_n = 0
-collapse_j = 0
+from stats import StatsParser
+from matcher import KeywordMatcher
+from logscan import map_file, open_mmap, iter_lines, iter_range, line_starts, find_all, last_line_with, tail_start
+from profiling import RenderTimer, profile_mode, request_profile, run_cprofile, take_profile, record_profile
+import metrics
+import search
+import catalog
+import rollups
+import progress
+import storage
+from progress import Progress
+from uploads import UploadSession, UploadError, ChunkError, tar_members, prune_sessions, CHUNK_MAX, UPLOAD_MAX
+from uploads import SESSION_IDLE, SESSIONS_MAX, SESSION_RETRY
+from uploads import block_hashes, rebuild_log, DELTA_BLOCK, DELTA_BLOCK_MIN, DELTA_BLOCK_MAX
+from scheduler import RenderScheduler, QueueFull
+from locks import file_lock, try_lock
+from hotcache import HotCache, read_entry
+from chartdata import ChartPayload
+
+
+class RenderContext:
+  # Element id counters of one rendered page, so renders running side by side
+  # in threads or processes produce the same ids as a render on its own.
+  # Segments of one page rendered in parallel keep their ids apart with a
+  # prefix, jobs are numbered across the page so they continue from job_base.
+
+  def __init__(self, prefix='', job_base=0):
+    self.prefix = prefix
+    self.chart_n = 0
+    self.chart_data_n = 0
+    self.collapse_n = 0
+    self.collapse_j = job_base
+
+  def collapse_id(self):
+    return f'{self.prefix}{self.collapse_n}' if self.prefix else self.collapse_n
 
 
 MAXBANDWIDTH=25000.
@@ -35,71 +74,107 @@ MAXBUFFER=2.
 STATS_INTERVAL=5.
 TASK_MAX=0.0025
 
-def add_collapse_start(title, classname=''):
-  global collapse_n
-  collapse_n += 1
+UPLOAD_BUCKETS=(0.1, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+RENDER_BUCKETS=(0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+LAG_BUCKETS=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30.)
+
+def cache_dir_size():
+  sizes = { 'html': 0, 'log': 0, 'companion': 0, 'other': 0 }
+  with os.scandir('cache') as it:
+    for entry in it:
+      if not entry.is_file():
+        continue
+      if entry.name.endswith('.html'):
+        kind = 'html'
+      elif entry.name.endswith('.log'):
+        kind = 'companion' if '_' in entry.name else 'log'
+      else:
+        kind = 'other'
+      try:
+        sizes[kind] += entry.stat().st_size
+      except FileNotFoundError:
+        pass
+  return sizes
+
+uploads_total = metrics.Counter('klipper_logs_uploads_total', 'Upload requests received')
+uploads_stored = metrics.Counter('klipper_logs_uploads_stored_total', 'Uploads stored by outcome', ('result',))
+upload_bytes = metrics.Counter('klipper_logs_upload_bytes_total', 'Bytes received in upload fields', ('field',))
+upload_seconds = metrics.Histogram('klipper_logs_upload_seconds', 'Upload request latency', UPLOAD_BUCKETS)
+render_seconds = metrics.Histogram('klipper_logs_render_seconds', 'Log render latency', RENDER_BUCKETS)
+renders_pending = metrics.Gauge('klipper_logs_renders_pending', 'Renders queued or in progress')
+renders_rejected = metrics.Counter('klipper_logs_renders_rejected_total', 'Renders not queued because the queue was full')
+html_cache = metrics.Counter('klipper_logs_html_cache_total', 'Rendered page lookups by cache result', ('result',))
+hot_responses = metrics.Counter('klipper_logs_hot_cache_total', 'Page and log responses by in-memory cache result', ('result',))
+hot_cache_bytes = metrics.Gauge('klipper_logs_hot_cache_bytes', 'Size of the responses kept in memory', func=lambda: hot_cache.size)
+loop_lag = metrics.Gauge('klipper_logs_event_loop_lag_seconds', 'Last measured event loop lag')
+loop_lag_seconds = metrics.Histogram('klipper_logs_event_loop_lag', 'Event loop lag distribution', LAG_BUCKETS)
+cache_bytes = metrics.Gauge('klipper_logs_cache_bytes', 'Size of the cache directory by file kind', ('kind',))
+
+def add_collapse_start(ctx, title, classname=''):
+  ctx.collapse_n += 1
   response = f'''<div class="card mb-2 mt-2" style="">
   <div style="transform: rotate(0);" class="card-header d-flex">
     <div>{title}</div>
-    <a id="collapseHeader{collapse_n}" class="ms-auto stretched-link collapsed" style="text-decoration:none" href="javascript:void(0)" onclick="collapseToggle('{collapse_n}')">Open spoiler</a>
+    <a id="collapseHeader{ctx.prefix}{ctx.collapse_n}" class="ms-auto stretched-link collapsed" style="text-decoration:none" href="javascript:void(0)" onclick="collapseToggle('{ctx.prefix}{ctx.collapse_n}')">Open spoiler</a>
   </div>
-  <div class="card-body text-break collapse {classname}" id="collapseExample{collapse_n}" style="white-space: break-spaces;">'''
+  <div class="card-body text-break collapse {classname}" id="collapseExample{ctx.prefix}{ctx.collapse_n}" style="white-space: break-spaces;">'''
   return response
 
-def add_collapse_end(title='', show_close=True):
-  global collapse_n
+def add_collapse_end(ctx, title='', show_close=True):
   close_text = 'Close' if show_close else ''
   response = f'''</div>
 <div class="card-footer d-flex" style="transform: rotate(0);">
-<a id="collapseFooter{collapse_n}" class="ms-auto stretched-link collapsed" href="#collapseHeader{collapse_n}" style="text-decoration:none" onclick="collapseToggle('{collapse_n}')"></a></div>
+<a id="collapseFooter{ctx.prefix}{ctx.collapse_n}" class="ms-auto stretched-link collapsed" href="#collapseHeader{ctx.prefix}{ctx.collapse_n}" style="text-decoration:none" onclick="collapseToggle('{ctx.prefix}{ctx.collapse_n}')"></a></div>
 </div>'''
   return response
 
-def add_collapse_job_start(title, classname=''):
-  global collapse_j
-  collapse_j += 1
+def add_collapse_job_start(ctx, title, classname=''):
+  ctx.collapse_j += 1
   response = f'''<div class="card mb-2 mt-2" style="">
   <div style="transform: rotate(0);" class="card-header d-flex">
     <div>{title}</div>
-    <a id="collapseHeaderJob{collapse_j}" class="ms-auto stretched-link collapsed" style="text-decoration:none" href="javascript:void(0)" onclick="collapseToggleJob('{collapse_j}')">Close spoiler</a>
+    <a id="collapseHeaderJob{ctx.collapse_j}" class="ms-auto stretched-link collapsed" style="text-decoration:none" href="javascript:void(0)" onclick="collapseToggleJob('{ctx.collapse_j}')">Close spoiler</a>
   </div>
-  <div class="card-body text-break collapse show {classname}" id="collapseExampleJob{collapse_j}" style="white-space: break-spaces;">'''
+  <div class="card-body text-break collapse show {classname}" id="collapseExampleJob{ctx.collapse_j}" style="white-space: break-spaces;">'''
   return response
 
-def add_collapse_job_end(title='', show_close=True):
-  global collapse_j
+def add_collapse_job_end(ctx, title='', show_close=True):
   close_text = 'Close' if show_close else ''
   response = f'''</div>
 <div class="card-footer d-flex" style="transform: rotate(0);">
-<a id="collapseFooterJob{collapse_j}" class="ms-auto stretched-link collapsed" href="#collapseHeaderJob{collapse_j}" style="text-decoration:none" onclick="collapseToggleJob('{collapse_j}')">Close spoiler</a></div>
+<a id="collapseFooterJob{ctx.collapse_j}" class="ms-auto stretched-link collapsed" href="#collapseHeaderJob{ctx.collapse_j}" style="text-decoration:none" onclick="collapseToggleJob('{ctx.collapse_j}')">Close spoiler</a></div>
 </div>'''
   return response
 
-def add_collapse(title, data):
-  response = add_collapse_start(title)
+def add_collapse(ctx, title, data):
+  response = add_collapse_start(ctx, title)
   response += data
-  response += add_collapse_end(title)
+  response += add_collapse_end(ctx, title)
   return response
 
-def add_chart_data(data):
-  global chart_data_n
-  chart_data_n += 1
+def new_chart_data(ctx):
+  # payload of the charts added until add_chart_data writes it
+  ctx.chart_data_n += 1
+  return ChartPayload()
+
+def add_chart_data(ctx, payload):
   response = f'''<script>
-var chart_data_{chart_data_n} = {data};
+var {get_chart_data_name(ctx)} = {payload.script()};
 </script>'''
   return response
 
-def get_chart_data_name():
-  global chart_data_n
-  return f'chart_data_{chart_data_n}'
+def get_chart_data_name(ctx):
+  return f'chart_data_{ctx.prefix}{ctx.chart_data_n}'
 
-def add_freqs_chart(keys, data, title='MCU frequencies'):
-  lists = { key: [d[key] for d in data if key in d] for key in keys if key != 'date' }
-  est_mhz = { key: round((sum(lists[key]) / len(lists[key])) / 1000000.) for key in lists }
-  freq_data = [ { key: d[key] if key == 'date' else ( d[key] - est_mhz[key] * 1000000.) / est_mhz[key] for key in d } for d in data ]
-  res = add_chart_data(freq_data)
-  res += add_chart({'Microsecond deviation': keys}, title)
-  return res
+def add_freqs_chart(ctx, payload, keys, data, title='MCU frequencies'):
+  columns = {}
+  for key in keys:
+    values = [d.get(key) for d in data]
+    present = [v for v in values if v is not None]
+    est_mhz = round((sum(present) / len(present)) / 1000000.)
+    columns[key] = [None if v is None else (v - est_mhz * 1000000.) / est_mhz for v in values]
+  table = payload.add_table([d['date'] for d in data], columns)
+  return add_chart(ctx, {'Microsecond deviation': keys}, title, table)
 
 def find_print_restarts(data):
   runoff_samples = {}
@@ -130,7 +205,7 @@ def find_print_restarts(data):
                    for sampletime in samples if not stall ]
   return sample_resets
 
-def add_mcu_chart(keys, data, title='MCU bandwidth and load utilization'):
+def add_mcu_chart(ctx, payload, keys, data, title='MCU bandwidth and load utilization'):
   sample_resets = find_print_restarts(data)
 
   mcu_load_data = []
@@ -195,98 +270,135 @@ def add_mcu_chart(keys, data, title='MCU bandwidth and load utilization'):
   bw_data_keys = [ f'{mcu}:{key}' for mcu in mcu_list for key in bandwidth_keys ]
   loads_data_keys = [ f'{mcu}:{key}' for mcu in mcu_list for key in loads_keys ]
 
-  res = add_chart_data(mcu_load_data)
-  res += add_chart({'Bandwidth': bw_data_keys, 'Loads': loads_data_keys}, title)
-  return res
+  table = payload.add_rows(mcu_load_data, bw_data_keys + loads_data_keys)
+  return add_chart(ctx, {'Bandwidth': bw_data_keys, 'Loads': loads_data_keys}, title, table)
 
 
-def add_chart(keys, title='Temperature stats'):
-  global chart_n
-  chart_n += 1
-  chart_id = f'chart_{chart_n}'
+def add_chart(ctx, keys, title='Temperature stats', table=0):
+  ctx.chart_n += 1
+  chart_id = f'chart_{ctx.prefix}{ctx.chart_n}'
 
-  chart_data_name = get_chart_data_name()
+  chart_data_name = get_chart_data_name(ctx)
 
-  response = add_collapse_start(title)
+  response = add_collapse_start(ctx, title)
   response += f'<div id="{chart_id}" style="width:100%; height:500px"></div>'
   x_data = json.dumps(keys, separators=(',', ':'))
   response += f'<script>'
 
   response += f'''
-createChart("{chart_id}", "{title}", {chart_data_name}, {x_data});
+createChart("{chart_id}", "{title}", {chart_data_name}[{table}], {x_data});
 </script>'''
-  response += add_collapse_end(title, False)
+  response += add_collapse_end(ctx, title, False)
   return response
   
+moonraker_keywords = (
+)
+
+moonraker_matcher = KeywordMatcher(info=moonraker_keywords)
+
+moonraker_event_matcher = KeywordMatcher(
+  error=('Error', 'Exception', 'Traceback', 'failed', 'Failed', 'Unable to'),
+  shutdown=('Unsafe Shutdown Count',),
+  klippy=('Klippy Disconnected', 'Klippy Connection Established', 'Klippy Connection Removed', 'Klippy Ready', 'Klippy ready'),
+  websocket=('Websocket Closed', 'Websocket Removed'),
+  update=('update_manager.py', 'git_deploy.py', 'app_deploy.py', 'Updating Repo', 'Update Complete'),
+)
+
+moonraker_event_priority = ('error', 'shutdown', 'klippy', 'websocket', 'update')
+
+MOONRAKER_MAX_EVENTS=1000
+
+def parse_moonraker_time(line):
+  # moonraker lines start with '2023-05-08 12:00:00,123 [file.py:func()] - '
+  try:
+    return datetime.datetime.strptime(line[:19], '%Y-%m-%d %H:%M:%S')
+  except ValueError:
+    return None
+
 def process_moonraker(moonraker):
   logging.info('processing moonraker file %s\n', moonraker)
   response = []
+  events = []
   
   sc = ''
 
-  file = open(moonraker, 'r')
+  with open_mmap(moonraker) as mm:
+    # only the last count is reported, so search from the end and stop there
+    line = last_line_with(mm, b'Unsafe Shutdown Count')
+    if line is not None:
+      sc = line.decode(errors='replace').split()[-1]
 
-#  keywords = (
-#  )
+    for line, found in moonraker_matcher.scan(mm):
+      response += [html.escape(line)]
 
-  for l in file:
-    line = l.rstrip('\n')
-    hline = html.escape(line)
-    
-    if 'Unsafe Shutdown Count' in line:
-      sc = line.split()[-1]
-
-#    if any(ext in line for ext in keywords):
-#      response += [hline]
+    # (time, source, kind, text, anchor) tuples in file order, merged later
+    # with the klippy timeline
+    for line, found in moonraker_event_matcher.scan(mm):
+      dt = parse_moonraker_time(line)
+      if dt is None:
+        continue
+      kind = next(k for k in moonraker_event_priority if k in found)
+      text = line.split('] - ', 1)[-1][:300]
+      events += [(dt, 'moonraker', kind, html.escape(text), '')]
+      if len(events) > 2 * MOONRAKER_MAX_EVENTS:
+        events = events[-MOONRAKER_MAX_EVENTS:]
 
-  file.close()
-  
   if sc:
     response += [f'Unsafe Shutdown Count: {sc}']
 
-  return response
-
+  return response, events[-MOONRAKER_MAX_EVENTS:]
+
+
+dmesg_keywords = (
+  'Kernel command line',
+  'ttyS',
+  'spi',
+  'btltty',
+  'cannot reset',
+  'annot enable',
+  'cannot disable',
+  'disabled by hub',
+  'status failed',
+  'I/O error',
+  'device disconnected',
+  'now attached to',
+  'device descriptor',
+  'New USB device',
+  ': Product:',
+  ': Manufacturer:',
+  ': SerialNumber:',
+)
+
+dmesg_red = (
+  'disabled by hub',
+  'I/O error'
+)
+
+dmesg_matcher = KeywordMatcher(info=dmesg_keywords, red=dmesg_red)
 
 def process_dmesg(dmesg):
   logging.info('processing dmesg file %s\n', dmesg)
   response = []
+  red = []
 
   file = open(dmesg, 'r')
 
-  keywords = (
-    'Kernel command line',
-    'ttyS',
-    'spi',
-    'btltty',
-    'cannot reset',
-    'annot enable',
-    'cannot disable',
-    'disabled by hub',
-    'status failed',
-    'I/O error',
-    'device disconnected',
-    'now attached to',
-    'device descriptor',
-    'device disconnected',
-    'New USB device',
-    ': Product:',
-    ': Manufacturer:',
-    ': SerialNumber:',
-  )
-
   try:
     for l in file:
       line = l.rstrip('\n')
-      hline = html.escape(line)
 
-      if any(ext in line for ext in keywords):
+      found = dmesg_matcher.match(line)
+      if found:
+        hline = html.escape(line)
         response += [hline]
+        if 'red' in found:
+          red += [hline]
   except:
     pass
 
   file.close()
 
-  return response
+  return response, red
   
 def process_debug(debug):
   logging.info('processing debug file %s\n', debug)
@@ -299,9 +411,143 @@ def process_debug(debug):
   return response
 
 
-def process_logfile(digest, htmlfile):
+COMPANION_WORKERS=3
+
+# cpus one render may keep busy with its segment and companion log workers,
+# render workers get their share of the machine through share_cpus
+render_cpus = os.cpu_count() or 1
+
+def share_cpus(renders):
+  # initializer of render worker processes, renders run at the same time
+  global render_cpus
+  render_cpus = max(1, (os.cpu_count() or 1) // renders)
+
+companion_executor = None
+
+def get_companion_executor():
+  global companion_executor
+  if companion_executor is None:
+    companion_executor = ProcessPoolExecutor(max_workers=min(COMPANION_WORKERS, render_cpus), mp_context=multiprocessing.get_context('spawn'))
+  return companion_executor
+
+def submit_companion(executor, func, filename, exists, default):
+  if executor and exists:
+    return executor.submit(func, filename)
+  future = Future()
+  future.set_result(func(filename) if exists else default)
+  return future
+
+
+# logs at least this big are split at Start printer lines and the parts are
+# rendered in worker processes, each Start printer resets the parser state
+SEGMENT_MIN_SIZE = 1024 * 1024 * 32
+
+# parser state a segment continues from, prescanned for every segment and
+# checked against the end state of the segment before it
+SEGMENT_CARRY = { 'restart_base': 0, 'job_base': 0, 'collapse_open': False, 'print_offset': 0, 'pydate': None }
+
+segment_executor = None
+
+def get_segment_executor():
+  global segment_executor
+  if segment_executor is None:
+    segment_executor = ProcessPoolExecutor(max_workers=render_cpus, mp_context=multiprocessing.get_context('spawn'))
+  return segment_executor
+
+def plan_segments(mm, count):
+  # (start, end, carry) of about count parts of similar size, end is the
+  # offset of the Start printer line opening the next part or None
+  if count < 2 or mm.find(b'.crealityprint') >= 0:
+    return []
+
+  starts = list(line_starts(mm, b'Start printer'))
+  rollovers = list(find_all(mm, b'Log rollover at'))
+  sd_starts = list(line_starts(mm, b'Starting SD card'))
+  sd_exits = list(line_starts(mm, b'Exiting SD card'))
+
+  cuts = []
+  for k in range(1, count):
+    i = bisect.bisect_left(starts, len(mm) * k // count)
+    if i < len(starts) and starts[i] > 0 and (not cuts or starts[i] > cuts[-1]):
+      cuts += [starts[i]]
+
+  segments = []
+  carry = dict(SEGMENT_CARRY)
+  for start, end in zip([0] + cuts, cuts + [None]):
+    segments += [(start, end, carry)]
+    if end is None:
+      break
+    n_rollovers = bisect.bisect_left(rollovers, end)
+    n_sd_starts = bisect.bisect_left(sd_starts, end)
+    n_sd_exits = bisect.bisect_left(sd_exits, end)
+    last_open = max(rollovers[n_rollovers - 1] if n_rollovers else -1, sd_starts[n_sd_starts - 1] if n_sd_starts else -1)
+    carry = dict(SEGMENT_CARRY,
+                 restart_base=bisect.bisect_left(starts, end) + n_rollovers,
+                 job_base=n_rollovers + n_sd_starts,
+                 collapse_open=last_open > (sd_exits[n_sd_exits - 1] if n_sd_exits else -1))
+  return segments
+
+def segment_file(digest, index):
+  return f'cache/{digest}.seg{index}'
+
+def render_segment(digest, index, start, end, carry):
+  return process_logfile(digest, segment_file(digest, index), parallel=False, segment=(index, start, end, carry))
+
+def render_segments(digest, segments):
+  # results of the segments in order, or None if the log has to be rendered
+  # in one piece. A segment whose prescanned carry-in turns out wrong for
+  # state it used is rendered again here with the real one.
+  executor = get_segment_executor()
+  jobs = [executor.submit(render_segment, digest, k, start, end, carry) for k, (start, end, carry) in enumerate(segments)]
+
+  results = []
+  actual = dict(SEGMENT_CARRY)
+  try:
+    for k, job in enumerate(jobs):
+      result = job.result()
+      start, end, carry = segments[k]
+      if any(carry[key] != actual[key] for key in result['carried']):
+        logging.info('segment %d of %s continues from a different state, rendering it again\n', k, digest)
+        result = render_segment(digest, k, start, end, actual)
+      if not result['finished']:
+        logging.warning('segment %d of %s does not end at a restart, rendering the log in one piece\n', k, digest)
+        break
+      results += [result]
+      actual = result['carry']
+  finally:
+    if len(results) < len(segments):
+      # segments still running would write their files again after they
+      # are removed
+      for job in jobs:
+        job.cancel()
+      wait(jobs)
+      remove_segments(digest, len(segments))
+  return results if len(results) == len(segments) else None
+
+def remove_segments(digest, count):
+  for k in range(count):
+    remove_files([segment_file(digest, k), progress.progress_file(digest, k)])
+
+def process_logfile(digest, htmlfile, profile='', parallel=True, segment=None):
+  profile = profile_mode(profile)
+  if profile == 'cprofile':
+    return run_cprofile(f'cache/{digest}.prof', process_logfile, digest, htmlfile, profile='timers', parallel=parallel)
+
+  # the progress file of a render that failed would show it running
+  try:
+    return render_logfile(digest, htmlfile, profile, parallel, segment)
+  finally:
+    progress.remove(progress.progress_file(digest, segment[0] if segment is not None else None))
+
+def render_logfile(digest, htmlfile, profile, parallel, segment):
+  timer = RenderTimer(bool(profile))
+  timed = timer.enabled
+
   logging.info('processing log file %s to %s\n', digest, htmlfile)
-  logfile = f'cache/{digest}.log'
+  store = storage.get()
+  logfile = store.fetch(f'{digest}.log')
+  if logfile is None:
+    raise FileNotFoundError(f'{digest}.log is not stored')
   name = logfile.split('/')[-1]
 
   mtime = os.path.getmtime(logfile)
@@ -311,34 +557,36 @@ def process_logfile(digest, htmlfile):
   expiration_line = f'<i>Logs will expire at {expstr}</i><br>'
 
   moonraker_name = f'{digest}_moonraker.log'
-  moonraker_file = os.path.join('cache', moonraker_name)
-  moonraker_exists = os.path.exists(moonraker_file)
+  moonraker_file = store.fetch(moonraker_name)
+  moonraker_exists = moonraker_file is not None
   moonraker_line = f'<a href="/klipper_logs/{moonraker_name}">Download moonraker logfile</a><br/>' if moonraker_exists else ''
-  
-  moonraker_info = process_moonraker(moonraker_file) if moonraker_exists else []
 
   dmesg_name = f'{digest}_dmesg.log'
-  dmesg_file = os.path.join('cache', dmesg_name)
-  dmesg_exists = os.path.exists(dmesg_file)
+  dmesg_file = store.fetch(dmesg_name)
+  dmesg_exists = dmesg_file is not None
   dmesg_line = f'<a href="/klipper_logs/{dmesg_name}">Download dmesg logfile</a><br/>' if dmesg_exists else ''
 
-  dmesg_info = process_dmesg(dmesg_file) if dmesg_exists else []
-
   debug_name = f'{digest}_debug.log'
-  debug_file = os.path.join('cache', debug_name)
-  debug_exists = os.path.exists(debug_file)
+  debug_file = store.fetch(debug_name)
+  debug_exists = debug_file is not None
   debug_line = f'<a href="/klipper_logs/{debug_name}">Download debug logfile</a><br/>' if debug_exists else ''
-  
-  debug_info = process_debug(debug_file) if debug_exists else []
+
+  # companion logs are analyzed in worker processes while klippy.log is
+  # parsed here, and joined when the page head is first written. A segment
+  # (index, start, end, carry) of the log renders only its part of the body.
+  executor = get_companion_executor() if parallel else None
+  if segment is not None:
+    moonraker_exists = dmesg_exists = debug_exists = False
+  moonraker_job = submit_companion(executor, process_moonraker, moonraker_file, moonraker_exists, ([], []))
+  dmesg_job = submit_companion(executor, process_dmesg, dmesg_file, dmesg_exists, ([], []))
+  debug_job = submit_companion(executor, process_debug, debug_file, debug_exists, [])
 
   crownest_name = f'{digest}_crownest.log'
-  crownest_file = os.path.join('cache', crownest_name)
-  crownest_exists = os.path.exists(crownest_file)
+  crownest_exists = store.exists(crownest_name)
   crownest_line = f'<a href="/klipper_logs/{crownest_name}">Download crownest logfile</a><br/>' if crownest_exists else ''
 
   telegram_name = f'{digest}_telegram.log'
-  telegram_file = os.path.join('cache', telegram_name)
-  telegram_exists = os.path.exists(telegram_file)
+  telegram_exists = store.exists(telegram_name)
   telegram_line = f'<a href="/klipper_logs/{telegram_name}">Download telegram logfile</a><br/>' if telegram_exists else ''
 
   response = '''<!doctype html>
@@ -459,6 +707,24 @@ function onLoad() {
     summary_node.appendChild(rt_h);
   }
 
+  if (summary.timeline && summary.timeline.length > 0) {
+    const timeline_len = summary.timeline.length;
+    const rt_h = createHtml(`<div class="card mb-2 mt-2"><div style="transform: rotate(0);" class="card-header d-flex"><div>Klipper and Moonraker timeline. Events: ${timeline_len}</div><a id="collapseHeaderTimeline" class="ms-auto stretched-link collapsed" href="javascript:void(0)" style="text-decoration:none" onclick="collapseToggle('Timeline')">Open spoiler</a></div></div>`);
+    const rt_body = createHtml(`<div class="card-body collapse" id="collapseExampleTimeline"></div>`);
+    const kind_class = {restart: "text-success", job: "text-primary", error: "text-danger", shutdown: "text-danger", klippy: "text-warning", websocket: "text-secondary", update: "text-info"};
+    for (let event = 0; event < summary.timeline.length; event++) {
+      const ev = summary.timeline[event];
+      const text = ev.id ? `<a href="#${ev.id}">${ev.text}</a>` : ev.text;
+      const rt = createHtml(`<div class="${kind_class[ev.kind] || ''}">${ev.time} [${ev.source} ${ev.kind}] ${text}</div>`);
+      rt_body.appendChild(rt);
+    }
+    rt_h.appendChild(rt_body);
+    const rt_f = createHtml(`</div><div class="card-footer d-flex" style="transform: rotate(0);"><a id="collapseFooterTimeline" class="ms-auto stretched-link collapsed" href="#collapseHeaderTimeline" style="text-decoration:none" onclick="collapseToggle('Timeline')"></a></div>
+</div>`);
+    rt_h.appendChild(rt_f);
+    summary_node.appendChild(rt_h);
+  }
+
   if (summary.lastErrors.length > 0) {
     const lr_info = createHtml(`<div class="card mt-3"><h6 class="card-header">Last run errors</h6></div>`);
     const lr_body = createHtml(`<div class="card-body"></div>`);
@@ -520,6 +786,43 @@ function onLoad() {
     console.log('hash:', location.hash);
   }
 }
+function decodeCharts(header, data) {
+// tables of chart samples sent as typed array columns, see ChartPayload
+const raw = atob(data);
+const bytes = new Uint8Array(raw.length);
+for (let i = 0; i < raw.length; i++) {
+  bytes[i] = raw.charCodeAt(i);
+}
+let offset = 0;
+return header.tables.map((table) => {
+  const n = table.rows;
+  let dates;
+  if (table.wide) {
+    offset += offset % 8;
+    dates = new Float64Array(bytes.buffer, offset, n);
+    offset += n * 8;
+  } else {
+    dates = new Int32Array(bytes.buffer, offset, n);
+    offset += n * 4;
+  }
+  const rows = new Array(n);
+  for (let i = 0; i < n; i++) {
+    rows[i] = { date: table.date + dates[i] };
+  }
+  for (const id of table.columns) {
+    const key = header.keys[id];
+    const column = new Float32Array(bytes.buffer, offset, n);
+    offset += n * 4;
+    for (let i = 0; i < n; i++) {
+      const value = column[i];
+      if (value === value) {
+        rows[i][key] = value;
+      }
+    }
+  }
+  return rows;
+});
+}
 function createChart(name, title, data, keys) {
 const root = am5.Root.new(name);
 root.utc = true;
@@ -649,23 +952,48 @@ return () => {
 {telegram_line}
 </p><div class="card mb-3"><h5 class="card-header">Summary info</h5><div class="card-body" id="summary"><div class="card-child">Please wait, page is loading</div></div></div>'''
 
-  if len(moonraker_info) > 0:
-    response += add_collapse_start('Moonraker info')
-    for d in moonraker_info:
-      response += d + '<br>'
-    response += add_collapse_end()
+  head = response
+  response = ''
+
+  companions = None
+
+  def join_companions():
+    nonlocal companions
+    if companions is None:
+      t = perf_counter()
+      companions = (moonraker_job.result(), dmesg_job.result(), debug_job.result())
+      if timed:
+        timer.add('companions_wait', t)
+    return companions
+
+  def write_head():
+    nonlocal head
 
-  if len(dmesg_info) > 0:
-    response += add_collapse_start('Dmesg info')
-    for d in dmesg_info:
-      response += d + '<br>'
-    response += add_collapse_end()
+    if head is None:
+      return
 
-  if len(debug_info) > 0:
-    response += add_collapse_start('Debug info')
-    for d in debug_info:
-      response += d
-    response += add_collapse_end()
+    (moonraker_info, _), (dmesg_info, _), debug_info = join_companions()
+
+    if len(moonraker_info) > 0:
+      head += add_collapse_start(ctx, 'Moonraker info')
+      for d in moonraker_info:
+        head += d + '<br>'
+      head += add_collapse_end(ctx)
+
+    if len(dmesg_info) > 0:
+      head += add_collapse_start(ctx, 'Dmesg info')
+      for d in dmesg_info:
+        head += d + '<br>'
+      head += add_collapse_end(ctx)
+
+    if len(debug_info) > 0:
+      head += add_collapse_start(ctx, 'Debug info')
+      for d in debug_info:
+        head += d
+      head += add_collapse_end(ctx)
+
+    out.write(head)
+    head = None
 
   date = 0
   pydate = None
@@ -673,7 +1001,9 @@ return () => {
   print_offset = 0
   mcu_stats = ''
   mcu_keys = []
+  mcu_key_set = set()
   mcu_data = []
+  stats_parser = StatsParser()
   
   collapse_open = False
 
@@ -682,40 +1012,49 @@ return () => {
     filter_keys = [ k for k in mcu_keys if k.split(':')[-1] in keys ]
     return filter_keys
 
-  def filter_data(keys):
-    nonlocal mcu_data
-    filter_keys = filter_data_keys(keys)
-    return ( filter_keys, [ { key: d[key] for key in d if key in filter_keys } for d in mcu_data ] )
-
   def get_charts():
     nonlocal mcu_data
     nonlocal mcu_keys
 
-    res = add_chart_data(mcu_data)
+    if timed:
+      t = perf_counter()
+      timer.count('chart_samples', len(mcu_data))
+
+    # the charts of this part share one payload written ahead of them
+    payload = new_chart_data(ctx)
 
     filter_temp_keys = ('date', 'temp', 'target', 'pwm', 'fan_speed')
     temp_keys = filter_data_keys(filter_temp_keys)
     pwm_keys = [ k for k in temp_keys if k.split(':')[-1] in ('pwm', 'fan_speed') ]
     temp_keys = [ k for k in temp_keys if k.split(':')[-1] in ('temp', 'target') ]
-    res += add_chart({ 'Temperature': temp_keys, 'PWM %': pwm_keys })
 
     filter_load_keys = ('date', 'cpudelta', 'sysload', 'memavail')
     load_keys = filter_data_keys(filter_load_keys)
     mem_keys = [ k for k in load_keys if k.split(':')[-1] in ('memavail',) ]
     sysload_keys = [ k for k in load_keys if k.split(':')[-1] in ('sysload',) ]
     cpudelta_keys = [ k for k in load_keys if k.split(':')[-1] in ('cpudelta',) ]
-    res += add_chart({ 'Load (% of all cores)': sysload_keys, 'Available memory (MB)': mem_keys, 'CPU delta': cpudelta_keys }, 'System load utilization')
+
+    table = payload.add_rows(mcu_data, temp_keys + pwm_keys + sysload_keys + mem_keys + cpudelta_keys)
+    charts = add_chart(ctx, { 'Temperature': temp_keys, 'PWM %': pwm_keys }, table=table)
+    charts += add_chart(ctx, { 'Load (% of all cores)': sysload_keys, 'Available memory (MB)': mem_keys, 'CPU delta': cpudelta_keys }, 'System load utilization', table)
 
     filter_freq_keys = ('date', 'freq', 'adj')
-    freq_keys, freq_data = filter_data(filter_freq_keys)
-    res += add_freqs_chart(freq_keys[1:], freq_data)
+    freq_keys = filter_data_keys(filter_freq_keys)
+    charts += add_freqs_chart(ctx, payload, freq_keys[1:], mcu_data)
 
     filter_mcu_keys = ('date', 'bytes_write', 'bytes_retransmit', 'mcu_task_avg', 'mcu_task_stddev')
     mcu_load_keys = filter_data_keys(filter_mcu_keys)
-    res += add_mcu_chart(mcu_load_keys[1:], mcu_data)
+    charts += add_mcu_chart(ctx, payload, mcu_load_keys[1:], mcu_data)
+
+    res = add_chart_data(ctx, payload) + charts
 
     mcu_data = []
     mcu_keys = []
+    mcu_key_set.clear()
+
+    if timed:
+      timer.add('charts', t)
+      timer.count('charts_bytes', len(res))
 
     return res
 
@@ -738,52 +1077,130 @@ return () => {
 
   print_stats_keys = (';', 'extruder:', 'pressure_advance_smooth_time:', 'toolhead:', 'max_accel:', 'max_accel_to_decel:', 'square_corner_velocity:', 'new minimum rtt', 'Ignoring clock sample')
 
+  ctx = RenderContext()
+
   summary = {}
   summary['fuckups'] = 0
   summary['config'] = ''
   summary['restarts'] = []
   summary['jobs'] = []
-
   summary['dmesg'] = []
-  dmesg_red = (
-    'disabled by hub',
-    'I/O error'
-  )
-  for dline in dmesg_info:
-    if any(dext in dline for dext in dmesg_red):
-      summary['dmesg'] += [dline]
 
   anchor_id = 0
 
   summary_errors = []
   summary_config = []
   summary_config_id = ''
+  # errors of all sessions, for the search index
+  index_errors = []
   
   versions = {}
+  mcu_types = {}
+
+  # (time, source, kind, text, anchor) in log order, see process_moonraker
+  klippy_timeline = []
 
   last_build_config = ''
 
   last_config_id = 0
 
+  restart_base = 0
+  segment_end = None
+  finished = False
+  # carry-in state the segment depends on, see render_segments
+  carried = set()
+
+  if segment is not None:
+    index, segment_start, segment_end, carry = segment
+    ctx = RenderContext(f'{index}_' if index else '', carry['job_base'])
+    restart_base = carry['restart_base']
+    collapse_open = carry['collapse_open']
+    pydate = carry['pydate']
+    # unknown until a Stats line of this segment sets it
+    print_offset = None
+    carried = {'restart_base', 'job_base', 'collapse_open'}
+    head = None
+
   file = open(logfile, 'rb')
   out = open(htmlfile, 'w+')
   ln = 0
 
-  for binline in file:
-    line = binline.decode().rstrip('\n')
-    hline = html.escape(line)
-
-    if '.crealityprint' in line:
+  # lines are classified on bytes where possible, decoded once, and html
+  # escaped only if they are not Stats lines, which never reach the output
+  mm = map_file(file)
+  mm_size = len(mm)
+  lines = iter_lines(mm)
+  results = None
+  if segment is not None:
+    lines = iter_lines(mm, segment_start) if segment_end is None else iter_range(mm, segment_start, segment_end)
+    tracker = Progress(digest, (segment_end or mm_size) - segment_start, index, segment_start)
+    tracker.update(segment_start, 0)
+  else:
+    tracker = Progress(digest, mm_size)
+    tracker.update(0, 0)
+
+  if segment is None and parallel and mm_size >= SEGMENT_MIN_SIZE:
+    segments = plan_segments(mm, render_cpus)
+    if segments:
+      tracker.update(0, 0, segments=len(segments))
+      t = perf_counter()
+      results = render_segments(digest, segments)
+      if timed:
+        timer.add('segments', t)
+
+  if results is not None:
+    # the body is stitched from the segments, the head gets its own ids
+    lines = ()
+    ctx = RenderContext('h')
+    write_head()
+    for k, result in enumerate(results):
+      with open(segment_file(digest, k)) as f:
+        shutil.copyfileobj(f, out)
+      remove_files([segment_file(digest, k), progress.progress_file(digest, k)])
+
+      # same summary key order as a render in one piece
+      for key in ('lastConfig', 'lastErrors'):
+        if key in result['summary']:
+          summary.setdefault(key, [])
+      summary['fuckups'] += result['summary']['fuckups']
+      summary['restarts'] += result['summary']['restarts']
+      summary['jobs'] += result['summary']['jobs']
+      if result['summary']['config'] != '':
+        last_config_id = result['summary']['config']
+        summary['config'] = last_config_id
+      index_errors += result['index_errors']
+      if k < len(results) - 1:
+        index_errors += result['errors']
+      versions.update(result['versions'])
+      mcu_types.update(result['mcu_types'])
+      klippy_timeline += result['timeline']
+      if result['build_config']:
+        last_build_config = result['build_config']
+    summary_errors = results[-1]['errors']
+    summary_config = results[-1]['summary_config']
+    tracker.update(mm_size, sum(result['lines'] for result in results))
+
+  loop_start = perf_counter()
+  for binline in lines:
+    if b'.crealityprint' in binline:
       out.close()
       out = open(htmlfile, 'w')
       response = 'Fucking Sonic Pad'
+      head = None
       mcu_data = []
       break
 
-    if len(line) == 0:
+    if binline == b'\n':
       response += '<span><br/></span>'
       continue
 
+    if timed:
+      t = perf_counter()
+      line = binline.decode().rstrip('\n')
+      timer.add('decode', t)
+    else:
+      line = binline.decode().rstrip('\n')
+
     newresponse = ''
 
     if line.endswith('Starting Klippy...') or line.startswith('Starting Klippy...') or line.startswith('Restarting printer'):
@@ -798,57 +1215,57 @@ return () => {
         fucked = True
 
       if autotune:
-        response += add_collapse_end('Autotune TMC')
+        response += add_collapse_end(ctx, 'Autotune TMC')
         autotune = False
         fucked = True
 
       if sent:
-        response += add_collapse_end('Sent')
+        response += add_collapse_end(ctx, 'Sent')
         sent = False
         fucked = True
 
       if receive:
-        response += add_collapse_end('Receive')
+        response += add_collapse_end(ctx, 'Receive')
         receive = False
         fucked = True
 
       if mcu_got:
-        response += add_collapse_end('MCU receive')
+        response += add_collapse_end(ctx, 'MCU receive')
         mcu_got = False
         fucked = True
 
       if received:
-        response += add_collapse_end('Received')
+        response += add_collapse_end(ctx, 'Received')
         received = False
         fucked = True
 
       if queue:
-        response += add_collapse_end('Last moves')
+        response += add_collapse_end(ctx, 'Last moves')
         queue = False
         fucked = True
 
       if oid:
-        response += add_collapse_end('MCU clock')
+        response += add_collapse_end(ctx, 'MCU clock')
         oid = False
         fucked = True
 
       if mesh:
-        response += add_collapse_end('Bed mesh')
+        response += add_collapse_end(ctx, 'Bed mesh')
         mesh = False
         fucked = True
 
       if config:
-        response += add_collapse_end('Config')
+        response += add_collapse_end(ctx, 'Config')
         config = False
         fucked = True
 
       if webhooks:
-        response += add_collapse_end('Webhooks')
+        response += add_collapse_end(ctx, 'Webhooks')
         webhooks = False
         fucked = True
 
       if print_stats:
-        response += add_collapse_end('Print comments')
+        response += add_collapse_end(ctx, 'Print comments')
         print_stats = False
         fucked = True
 
@@ -868,12 +1285,12 @@ return () => {
         fucked = True
 
       if config:
-        response += add_collapse_end('Config')
+        response += add_collapse_end(ctx, 'Config')
         config = False
         fucked = True
 
       if prediction:
-        response += add_collapse_end('Resetting prediction variance')
+        response += add_collapse_end(ctx, 'Resetting prediction variance')
         prediction = False
         fucked = True
 
@@ -892,7 +1309,7 @@ return () => {
 
     if print_stats and not any(line.startswith(k) for k in print_stats_keys) and not line.startswith('Stats '):
       print_stats = False
-      response += add_collapse_end('Print comments')
+      response += add_collapse_end(ctx, 'Print comments')
 
     if no_such and 'No such file or directory' not in line:
       no_such = False
@@ -904,25 +1321,34 @@ return () => {
 
     if autotune and not line.startswith('autotune_tmc'):
       autotune = False
-      response += add_collapse_end('Autotune TMC')
+      response += add_collapse_end(ctx, 'Autotune TMC')
 
     if receive and not line.startswith('Receive: '):
       receive = False
-      response += add_collapse_end('Receive')
+      response += add_collapse_end(ctx, 'Receive')
 
     if mcu_got and ': got {' not in line:
       mcu_got = False
-      response += add_collapse_end('MCU receive')
+      response += add_collapse_end(ctx, 'MCU receive')
 
     if webhooks and not line.startswith('webhooks: '):
       webhooks = False
-      response += add_collapse_end('Webhooks')
+      response += add_collapse_end(ctx, 'Webhooks')
+
+    is_stats = line.startswith('Stats ')
+    if not is_stats:
+      if timed:
+        t = perf_counter()
+        hline = html.escape(line)
+        timer.add('escape', t)
+      else:
+        hline = html.escape(line)
 
-    if line.startswith('Stats '):
+    if is_stats:
+      if timed:
+        t = perf_counter()
+        timer.count('stats_lines')
       d1 = line.replace('sysload=', 'sysinfo: sysload=').split()
-      item = {}
-      name = ''
-
       st = round(float(d1[1][:-1]) * 10) / 10
       if time_offset == 0:
         time_offset = st
@@ -930,36 +1356,8 @@ return () => {
       sampletime = round((st - time_offset) * 10) / 10
       timestamp = int((sampletime + date) * 1000)
 
-      item['sampletime'] = sampletime
-      item['date'] = timestamp
-
-      mcu_stats += f'{sampletime} '
-
-      for it in d1[3:]:
-        if it.endswith(':'):
-          name = it[:-1]
-          mcu_stats += f'[{name}]: '
-
-        else:
-          tmp = it.split('=')
-          if len(tmp) == 2:
-            key, v = tmp
-            value = float("{:.6f}".format(float(v)))
-
-            if key == 'pwm':
-              value = int(value * 100)
-
-            if key == 'fan_speed':
-              value = int(value * 100)
-
-            elif key == 'memavail':
-              value = value / 1024.
-
-            elif key == 'sysload':
-              value = value * 100.
-
-            item[f'{name}:{key}'] = value
-            mcu_stats += f'{key}: {v} '
+      item = { 'sampletime': sampletime, 'date': timestamp }
+      mcu_stats += f'{sampletime} ' + stats_parser.parse(d1[3:], item)
 
       print_offset = st - (round(float(item['sysinfo:print_time']) * 100) / 100)
 
@@ -976,43 +1374,41 @@ return () => {
         else:
           item['sysinfo:cpudelta'] = 0
 
-      filter_keys = (
-        'date', 'sampletime',
-        'temp', 'target', 'pwm', 'fan_speed',
-        'freq', 'adj',
-        'cputime', 'cpudelta', 'sysload', 'memavail',
-        'buffer_time', 'print_stall', 'bytes_write', 'bytes_retransmit', 'mcu_task_avg', 'mcu_task_stddev', 'print_time'
-        )
-      item = { k: item[k] for k in item if k.split(':')[-1] in filter_keys }
-
-      for key in item:
-        if not key in mcu_keys:
-          mcu_keys += [key]
+      if not mcu_key_set.issuperset(item):
+        for key in item:
+          if not key in mcu_key_set:
+            mcu_key_set.add(key)
+            mcu_keys += [key]
 
       mcu_stats += '\n'
       mcu_data += [item]
+      if timed:
+        timer.add('stats', t)
 
     elif line == 'bed_mesh: generated points':
       mesh = True
-      response += add_collapse_start('Bed Mesh generated points')
+      response += add_collapse_start(ctx, 'Bed Mesh generated points')
 
     elif mesh and (' Tool Adjusted ' in line or ' | (' in line):
       response += hline + '\n'
 
     elif line == '========= Last MCU build config =========':
       build_config = True
-      response += add_collapse_start('Last Build Config')
+      response += add_collapse_start(ctx, 'Last Build Config')
       last_build_config = ''
 
     elif line == '=======================' and build_config:
       build_config = False
-      response += add_collapse_end('Last Build Config')
+      response += add_collapse_end(ctx, 'Last Build Config')
 
-      response += add_collapse_start('Firmware configuration')
+      response += add_collapse_start(ctx, 'Firmware configuration')
+      t = perf_counter()
       config_out = print_config(last_build_config)
+      if timed:
+        timer.add('print_config', t)
       for c in config_out:
         response += c + '<br>'
-      response += add_collapse_end('Firmware configuration')
+      response += add_collapse_end(ctx, 'Firmware configuration')
 
     elif build_config:
       response += hline + '\n'
@@ -1020,14 +1416,13 @@ return () => {
 
     elif line == '===== Config file =====':
       config = True
-      response += add_collapse_start('Config', 'code')
-      global collapse_n
-      last_config_id = collapse_n
+      response += add_collapse_start(ctx, 'Config', 'code')
+      last_config_id = ctx.collapse_id()
       summary['config'] = last_config_id
 
     elif line == '=======================' and config:
       config = False
-      response += add_collapse_end('Config')
+      response += add_collapse_end(ctx, 'Config')
 
     elif config:
       summary_config += [line]
@@ -1037,8 +1432,8 @@ return () => {
     elif 'No such file or directory' in line and not no_such and not traceback:
       no_such = True
       anchor_id += 1
-      response += f'<div id="anchor{anchor_id}" class="card card-body text-break alert alert-danger" style="white-space: break-spaces">{hline}\n'
-      summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+      response += f'<div id="anchor{ctx.prefix}{anchor_id}" class="card card-body text-break alert alert-danger" style="white-space: break-spaces">{hline}\n'
+      summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
     elif no_such:
       response += hline + '\n'
@@ -1046,8 +1441,8 @@ return () => {
     elif 'Unable to open serial port' in line and not no_port and not traceback:
       no_port = True
       anchor_id += 1
-      response += f'<div id="anchor{anchor_id}" class="card card-body text-break alert alert-danger" style="white-space: break-spaces">{hline}\n'
-      summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+      response += f'<div id="anchor{ctx.prefix}{anchor_id}" class="card card-body text-break alert alert-danger" style="white-space: break-spaces">{hline}\n'
+      summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
     elif no_port:
       response += hline + '\n'
@@ -1055,7 +1450,7 @@ return () => {
     elif line.startswith('Traceback ') and not traceback:
       traceback = True
       anchor_id += 1
-      response += f'<div id="anchor{anchor_id}" class="card card-body text-break alert alert-danger" style="white-space: break-spaces">{hline}\n'
+      response += f'<div id="anchor{ctx.prefix}{anchor_id}" class="card card-body text-break alert alert-danger" style="white-space: break-spaces">{hline}\n'
 
     # elif line.lstrip().startswith('raise ') and traceback:
     #   traceback = False
@@ -1064,143 +1459,151 @@ return () => {
     elif line.lstrip().lower().split()[0].endswith('error:') and traceback:
       traceback = False
       response += f'{hline}</div>'
-      summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+      summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
     elif traceback:
       response += hline + '\n'
 
     elif line.startswith('Sent '):
       if not sent:
-        response += add_collapse_start('Sent')
+        response += add_collapse_start(ctx, 'Sent')
         sent = True
 
       response += f'{hline}<br/>'
 
     elif any(line.startswith(k) for k in print_stats_keys):
       if not print_stats:
-        response += add_collapse_start('Print comments')
+        response += add_collapse_start(ctx, 'Print comments')
         print_stats = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('Receive: '):
       if not receive:
-        response += add_collapse_start('Receive')
+        response += add_collapse_start(ctx, 'Receive')
         receive = True
 
       response += f'{hline}<br/>'
 
     elif ': got {' in line:
       if not mcu_got:
-        response += add_collapse_start('MCU receive')
+        response += add_collapse_start(ctx, 'MCU receive')
         mcu_got = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('Received '):
       if not received:
-        response += add_collapse_start('Received')
+        response += add_collapse_start(ctx, 'Received')
         received = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('queue_step '):
       if not queue:
-        response += add_collapse_start('Queue steps')
+        response += add_collapse_start(ctx, 'Queue steps')
         queue = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('move '):
       if not queue:
-        response += add_collapse_start('Last moves')
+        response += add_collapse_start(ctx, 'Last moves')
         queue = True
 
       response += f'{hline}<br/>'
 
     elif "got {'oid': " in line:
       if not oid:
-        response += add_collapse_start('MCU clock')
+        response += add_collapse_start(ctx, 'MCU clock')
         oid = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('autotune_tmc'):
       if not autotune:
-        response += add_collapse_start('Autotune TMC')
+        response += add_collapse_start(ctx, 'Autotune TMC')
         autotune = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('Resetting prediction variance'):
       if not prediction:
-        response += add_collapse_start('Resetting prediction variance')
+        response += add_collapse_start(ctx, 'Resetting prediction variance')
         prediction = True
 
       response += f'{hline}<br/>'
 
     elif line.startswith('webhooks: '):
       if not webhooks:
-        response += add_collapse_start('Webhooks')
+        response += add_collapse_start(ctx, 'Webhooks')
         webhooks = True
 
       response += f'{hline}<br/>'
 
     else:
       if autotune:
-        response += add_collapse_end('Autotune TMC')
+        response += add_collapse_end(ctx, 'Autotune TMC')
         autotune = False
 
       if prediction:
-        response += add_collapse_end('Resetting prediction variance')
+        response += add_collapse_end(ctx, 'Resetting prediction variance')
         prediction = False
 
       if sent:
-        response += add_collapse_end('Sent')
+        response += add_collapse_end(ctx, 'Sent')
         sent = False
 
       if receive:
-        response += add_collapse_end('Receive')
+        response += add_collapse_end(ctx, 'Receive')
         receive = False
 
       if mcu_got:
-        response += add_collapse_end('MCU receive')
+        response += add_collapse_end(ctx, 'MCU receive')
         mcu_got = False
 
       if received:
-        response += add_collapse_end('Received')
+        response += add_collapse_end(ctx, 'Received')
         received = False
 
       if queue:
-        response += add_collapse_end('Last moves')
+        response += add_collapse_end(ctx, 'Last moves')
         queue = False
 
       if oid:
-        response += add_collapse_end('MCU clock')
+        response += add_collapse_end(ctx, 'MCU clock')
         oid = False
 
       if mesh:
-        response += add_collapse_end('Bed mesh')
+        response += add_collapse_end(ctx, 'Bed mesh')
         mesh = False
 
       if print_stats:
-        response += add_collapse_end('Print comments')
+        response += add_collapse_end(ctx, 'Print comments')
         print_stats = False
 
       if line.startswith('Start printer'):
         if len(mcu_stats) > 0:
-          response += add_collapse('MCU Stats', mcu_stats)
+          response += add_collapse(ctx, 'MCU Stats', mcu_stats)
           mcu_stats = ''
 
         if len(mcu_data) > 0:
           newresponse += get_charts()
 
+        if segment_end is not None and mm.tell() > segment_end:
+          # first line of the next segment, which renders it from here on
+          response += newresponse
+          finished = True
+          break
+
         date = int(float(line.split()[8][1:]))
+        stats_parser = StatsParser()
         summary['lastConfig'] = []
         summary['lastErrors'] = []
         summary.setdefault('restarts', []).append(' '.join(line.split()[3:-2]))
-        restart_id = len(summary['restarts']) - 1
+        restart_id = restart_base + len(summary['restarts']) - 1
 
+        index_errors += summary_errors
         summary_errors = []
         summary_config = []
 
@@ -1209,8 +1612,10 @@ return () => {
         try:
           dat = datetime.datetime.strptime(dtline, '%a %b %d %H:%M:%S %Y')
           pydate = dat.replace(tzinfo=datetime.timezone.utc)
+          klippy_timeline += [(dat, 'klippy', 'restart', 'Klipper start', f'restart_{restart_id}')]
         except:
-          pass
+          if ln == 0:
+            carried.add('pydate')
         newresponse += f'<div class="alert alert-success" role="alert" id="restart_{restart_id}">{line}</div>'
 
       elif 'Log rollover at' in line:
@@ -1221,13 +1626,15 @@ return () => {
           date = pydate.timestamp()
           time_offset = 0
         except:
-          pass
+          dat = None
           
         dateinfo = line.split()[4:-1]
         datestr = ' '.join(dateinfo)
         
         summary.setdefault('restarts', []).append(datestr)
-        restart_id = len(summary['restarts']) - 1
+        restart_id = restart_base + len(summary['restarts']) - 1
+        if dat:
+          klippy_timeline += [(dat, 'klippy', 'restart', 'Log rollover', f'restart_{restart_id}')]
         
         summary.setdefault('jobs', []).append(datestr)
         job_id = len(summary['jobs']) - 1
@@ -1235,14 +1642,14 @@ return () => {
         dtline = ' '.join(line.split()[1:-1])
         newresponse += f'<div class="alert alert-success" role="alert" id="restart_{restart_id}">{dtline}</div>'
         
-        newresponse += add_collapse_job_start(f'Possible print job rollover at: {datestr}')
+        newresponse += add_collapse_job_start(ctx, f'Possible print job rollover at: {datestr}')
         collapse_open = True
         
 #        newresponse += f'<div class="alert alert-success" role="alert" id="job_{job_id}">Possible print job rollover at: {datestr}</div>'
 
       elif line.startswith('Loaded MCU'):
         if len(mcu_stats) > 0:
-          response += add_collapse('MCU Stats', mcu_stats)
+          response += add_collapse(ctx, 'MCU Stats', mcu_stats)
           mcu_stats = ''
 
         if len(mcu_data) > 0:
@@ -1257,20 +1664,23 @@ return () => {
         newresponse += f'<div class="alert alert-warning" role="alert">MCU {mcuname} version {mcuversion}</div>'
 
       elif line.startswith('Virtual sdcard ('):
-        newresponse += add_collapse_start('Virtual sdcard buffer')
+        newresponse += add_collapse_start(ctx, 'Virtual sdcard buffer')
         t = "): '"
         if "n'" in line:
           t = "): n'"
         newresponse += html.escape(line.split("'")[1][:-1].replace('\\r', '').replace('\\n', '\n'))
-        newresponse += add_collapse_end('')
+        newresponse += add_collapse_end(ctx, '')
 
       elif line.startswith('Upcoming ('):
-        newresponse += add_collapse_start('Virtual sdcard upcoming buffer')
+        newresponse += add_collapse_start(ctx, 'Virtual sdcard upcoming buffer')
         newresponse += html.escape(line.split("'")[1][:-1].replace('\\r', '').replace('\\n', '\n'))
-        newresponse += add_collapse_end('')
+        newresponse += add_collapse_end(ctx, '')
 
       elif 'at shutdown time' in line:
         newresponse += hline.rstrip() + '<br>'
+        if print_offset is None:
+          carried.add('print_offset')
+          print_offset = carry['print_offset']
         stime = round(float(line.split()[-4][:-1]) * 100) / 100 + print_offset - time_offset
         dt = pydate + datetime.timedelta(seconds=stime)
         tline = dt.strftime('%a %b %d %H:%M:%S %Y')
@@ -1278,7 +1688,7 @@ return () => {
 
       elif line.startswith('Exiting SD card'):
         if len(mcu_stats) > 0:
-          response += add_collapse('MCU Stats', mcu_stats)
+          response += add_collapse(ctx, 'MCU Stats', mcu_stats)
           mcu_stats = ''
 
         if len(mcu_data) > 0:
@@ -1286,31 +1696,37 @@ return () => {
           
         newresponse += f'<div class="alert alert-warning" role="alert">{hline}</div>'
           
-        newresponse += add_collapse_job_end(f'{hline}')
+        newresponse += add_collapse_job_end(ctx, f'{hline}')
         collapse_open = False
 
       elif line.startswith('Starting SD card'):
         if len(mcu_stats) > 0:
-          response += add_collapse('MCU Stats', mcu_stats)
+          response += add_collapse(ctx, 'MCU Stats', mcu_stats)
           mcu_stats = ''
 
         timestr = ''
+        job_time = None
 
         if len(mcu_data) > 0:
           pdate = mcu_data[-1]['date'] / 1000
           mdate = datetime.datetime.fromtimestamp(pdate)
           timestr = mdate.strftime('%a %b %d %H:%M:%S %Y')
+          if pydate:
+            job_time = pydate.replace(tzinfo=None) + datetime.timedelta(seconds=mcu_data[-1]['sampletime'])
           newresponse += get_charts()
           
         summary.setdefault('jobs', []).append(timestr)
         job_id = len(summary['jobs']) - 1
         
         if collapse_open:
-          newresponse += add_collapse_job_end()
+          newresponse += add_collapse_job_end(ctx)
           
-        newresponse += add_collapse_job_start(f'{hline} at: {timestr}')
+        newresponse += add_collapse_job_start(ctx, f'{hline} at: {timestr}')
         collapse_open = True
 
+        if job_time:
+          klippy_timeline += [(job_time, 'klippy', 'job', hline, f'collapseHeaderJob{ctx.collapse_j}')]
+
 #        newresponse += f'<div class="alert alert-warning" role="alert" id="job_{job_id}">{hline} at: {timestr}</div>'
 
       elif line.startswith('Finished SD card print'):
@@ -1328,11 +1744,11 @@ return () => {
       elif line.startswith('Git version'):
         newresponse += f'<div class="alert alert-warning" role="alert">{hline}</div>'
         versions['git'] = line.split()[-1][1:-1]
-        newresponse += add_collapse_start('Git info')
+        newresponse += add_collapse_start(ctx, 'Git info')
         
       elif line.startswith('Tracked URL: '):
         newresponse += hline.rstrip() + '<br>'
-        newresponse += add_collapse_end()
+        newresponse += add_collapse_end(ctx)
 
       elif line.startswith('Python:'):
         newresponse += f'<div class="alert alert-secondary" role="alert">{hline}</div>'
@@ -1354,8 +1770,8 @@ return () => {
 
       elif any(t in line for t in ("' shutdown: ", "Got EOF ", "Got error ")):
         anchor_id += 1
-        newresponse += f'<div id="anchor{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
-        summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+        newresponse += f'<div id="anchor{ctx.prefix}{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
+        summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
       elif line.startswith('Timeout with MCU'):
         anchor_id += 1
@@ -1373,32 +1789,32 @@ return () => {
           pass
 
         newline = f'{hline.strip()} ({timestr})'
-        newresponse += f'<div id="anchor{anchor_id}" class="alert alert-danger" role="alert">{newline}</div>'
-        summary_errors += [{'id':f'anchor{anchor_id}', 'text':newline.strip()}]
+        newresponse += f'<div id="anchor{ctx.prefix}{anchor_id}" class="alert alert-danger" role="alert">{newline}</div>'
+        summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':newline.strip()}]
 
       elif line.startswith('Transition to shutdown state'):
         anchor_id += 1
-        newresponse += f'<div id="anchor{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
-        summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+        newresponse += f'<div id="anchor{ctx.prefix}{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
+        summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
       elif 'Warning!)' in line:
         anchor_id += 1
-        newresponse += f'<div id="anchor{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
-        summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+        newresponse += f'<div id="anchor{ctx.prefix}{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
+        summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
       elif 'Error!)' in line:
         anchor_id += 1
-        newresponse += f'<div id="anchor{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
-        summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+        newresponse += f'<div id="anchor{ctx.prefix}{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
+        summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
       elif 'Shutdown!)' in line:
         anchor_id += 1
-        newresponse += f'<div id="anchor{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
-        summary_errors += [{'id':f'anchor{anchor_id}', 'text':hline.strip()}]
+        newresponse += f'<div id="anchor{ctx.prefix}{anchor_id}" class="alert alert-danger" role="alert">{hline}</div>'
+        summary_errors += [{'id':f'anchor{ctx.prefix}{anchor_id}', 'text':hline.strip()}]
 
       elif line.startswith('Starting Klippy'):
         if len(mcu_stats) > 0:
-          response += add_collapse('MCU Stats', mcu_stats)
+          response += add_collapse(ctx, 'MCU Stats', mcu_stats)
           mcu_stats = ''
 
         if len(mcu_data) > 0:
@@ -1414,13 +1830,19 @@ return () => {
 
       elif line.startswith('Args: ['):
         args = json.loads(line[6:].replace("'", '"'))
-        newresponse += add_collapse_start('Args')
+        newresponse += add_collapse_start(ctx, 'Args')
         newresponse += ' '.join(args)
-        newresponse += add_collapse_end('Args')
+        newresponse += add_collapse_end(ctx, 'Args')
         
 #        elif 'reports GSTAT:' in line:
 #            newresponse += f'<pre  style="background: #f00;color:#fff">{line}</pre>'
 
+      elif line.startswith("MCU '") and "' config: " in line:
+        for it in line.split():
+          if it.startswith('MCU='):
+            mcu_types[line.split("'")[1]] = it[4:]
+        newresponse += hline.rstrip() + '<br>'
+
       elif len(line.strip()) > 0:
         newresponse += hline.rstrip() + '<br>'
 
@@ -1429,30 +1851,71 @@ return () => {
 
     ln += 1
 
-    if ln % 50000 == 0:
-      out.write(response)
-      out.flush()
-      response = ''
+    if ln % 1000 == 0:
+      tracker.tick(mm.tell(), ln)
+
+      if ln % 50000 == 0:
+        write_head()
+        t = perf_counter()
+        out.write(response)
+        out.flush()
+        if timed:
+          timer.add('write', t)
+        response = ''
 
+  if mm:
+    mm.close()
   file.close()
+  if timed:
+    timer.remainder('classify', loop_start, ('decode', 'escape', 'stats', 'charts', 'print_config', 'write', 'companions_wait'))
+    timer.count('lines', ln)
 
   if print_stats:
-    response += add_collapse_end('Print comments')
+    response += add_collapse_end(ctx, 'Print comments')
     print_stats = False
 
   if len(mcu_stats) > 0:
-    response += add_collapse('MCU Stats', mcu_stats)
+    response += add_collapse(ctx, 'MCU Stats', mcu_stats)
     mcu_stats = ''
 
   if len(mcu_data) > 0:
     response += get_charts()
     
-  if collapse_open:
-    response += add_collapse_job_end()
+  if collapse_open and segment_end is None:
+    response += add_collapse_job_end(ctx)
 
+  write_head()
   out.write(response)
   out.flush()
 
+  if segment is not None:
+    out.close()
+    # kept until the segments are stitched, so the finished part still counts
+    tracker.update(segment_end or mm_size, ln)
+    return {
+      'finished': finished or segment_end is None,
+      'carried': carried,
+      'carry': {
+        'restart_base': restart_base + len(summary['restarts']),
+        'job_base': ctx.collapse_j,
+        'collapse_open': collapse_open,
+        'print_offset': carry['print_offset'] if print_offset is None else print_offset,
+        'pydate': pydate,
+      },
+      'summary': summary,
+      'errors': summary_errors,
+      'index_errors': index_errors,
+      'summary_config': summary_config,
+      'versions': versions,
+      'mcu_types': mcu_types,
+      'timeline': klippy_timeline,
+      'build_config': last_build_config,
+      'lines': ln,
+    }
+
+  (_, moonraker_events), (_, dmesg_errors), _ = join_companions()
+  summary['dmesg'] = dmesg_errors
+
   summary['lastErrors'] = summary_errors
   last_config = []
   mcu_serials = []
@@ -1486,6 +1949,14 @@ return () => {
   summary['lastConfig'] = last_config
   summary['versions'] = versions.copy()
   summary['versions_ok'] = False
+  summary['mcuTypes'] = mcu_types
+
+  if moonraker_exists:
+    # klippy times jump back when the host clock is set late (NTP after
+    # boot), so the lists are not merged as if they were in order
+    timeline = sorted(klippy_timeline + moonraker_events, key=lambda e: e[0])
+    summary['timeline'] = [ {'time': dt.strftime('%Y-%m-%d %H:%M:%S'), 'source': source, 'kind': kind, 'text': text, 'id': anchor}
+                            for dt, source, kind, text, anchor in timeline ]
   
   if 'git' in versions:
     git_version = versions.pop('git')
@@ -1494,10 +1965,20 @@ return () => {
         summary['versions_ok'] = True
         break
 
+  index_errors += summary_errors
+  search.index_log(digest, mtime,
+                   dict.fromkeys(html.unescape(e['text']) for e in index_errors),
+                   list(versions) + last_build_config.splitlines(),
+                   [f'{k} {v}' for k, v in summary['versions'].items()],
+                   summary_config)
+
   response = f'''<script>
 summary = {json.dumps(summary)};
 </script>'''
 
+  if timed:
+    timer.count('output_bytes', out.tell() + len(response))
+
 #  if len(response) > 100:
 #    response += '</body></html>'
   out.write(response)
@@ -1505,6 +1986,10 @@ summary = {json.dumps(summary)};
   out.flush()
   out.close()
 
+  timer.finish(digest)
+
+  return summary
+
 async def handle_index(request: web.Request) -> web.StreamResponse:
   return web.FileResponse("index.html", chunk_size=256 * 1024)
 
@@ -1548,38 +2033,29 @@ async def handle_list(request: web.Request) -> web.StreamResponse:
 <div class="container-fluid">
 '''
 
-  files = [f for f in os.listdir('cache') if f.endswith('.log') and not '_' in f]
-  files.sort(key=lambda x: os.path.getmtime(f'cache/{x}'))
+  for entry in catalog.listing():
+    digest = entry['digest']
 
-  for file in reversed(files):
-    digest = file.split('.')[0]
-    htmlfile = f'cache/{file}'
-    logfile = f'cache/{digest}.log'
-    moonrakerfile = f'cache/{digest}_moonraker.log'
-    dmesgfile = f'cache/{digest}_dmesg.log'
-    debugfile = f'cache/{digest}_debug.log'
-
-    mtime = os.path.getmtime(logfile)
-    mdate = datetime.datetime.fromtimestamp(mtime)
+    mdate = datetime.datetime.fromtimestamp(entry['mtime'])
     timestr = mdate.strftime('%d-%m-%Y %H:%M:%S')
 
     response += '<div class="row mb-2 mt-2 mx-1 row-cols-5">'
 
     response += f'<a type="button" class="btn btn-outline-secondary col" href="/klipper_logs/{digest}">{timestr}</button>'
 
-    klippysize = sizeof_fmt(os.stat(logfile).st_size)
+    klippysize = sizeof_fmt(entry['size'])
     response += f'<a type="button" class="btn btn-outline-secondary col" href="/klipper_logs/{digest}.log">klippy.log ({klippysize})</button>'
 
-    if os.path.exists(moonrakerfile):
-      moonrakersize = sizeof_fmt(os.stat(moonrakerfile).st_size)
+    if entry['moonraker'] is not None:
+      moonrakersize = sizeof_fmt(entry['moonraker'])
       response += f'<a type="button" class="btn btn-outline-secondary col" href="/klipper_logs/{digest}_moonraker.log">moonraker.log ({moonrakersize})</button>'
 
-    if os.path.exists(dmesgfile):
-      dmesgsize = sizeof_fmt(os.stat(dmesgfile).st_size)
+    if entry['dmesg'] is not None:
+      dmesgsize = sizeof_fmt(entry['dmesg'])
       response += f'<a type="button" class="btn btn-outline-secondary col" href="/klipper_logs/{digest}_dmesg.log">dmesg.log ({dmesgsize})</button>'
 
-    if os.path.exists(debugfile):
-      debugsize = sizeof_fmt(os.stat(debugfile).st_size)
+    if entry['debug'] is not None:
+      debugsize = sizeof_fmt(entry['debug'])
       response += f'<a type="button" class="btn btn-outline-secondary col" href="/klipper_logs/{digest}_debug.log">debug.log ({debugsize})</button>'
 
     response += '</div>'
@@ -1588,21 +2064,384 @@ async def handle_list(request: web.Request) -> web.StreamResponse:
   response.headers['Content-Type'] = 'text/html'
   return response  
 
+async def handle_search(request: web.Request) -> web.StreamResponse:
+  query = request.query.get('q', '').strip()
+  try:
+    days = float(request.query.get('days', 0))
+    limit = max(1, min(int(request.query.get('limit', 50)), 500))
+  except ValueError:
+    raise web.HTTPBadRequest(text='days and limit must be numbers')
+
+  results = []
+  if query:
+    results = await asyncio.get_running_loop().run_in_executor(None, search.search, query, days, limit)
+    if results is None:
+      raise web.HTTPServiceUnavailable(text='full text search is not available, sqlite3 has no fts5 support')
+
+  if request.query.get('format') == 'json':
+    return web.json_response(results)
+
+  response = f'''<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Klipper Log Parser</title>
+<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-rbsA2VBKQhggwzxH7pPCaAqO46MgnOM80zW1RWuH61DGLwZJEdK2Kadq2F9CUG65" crossorigin="anonymous">
+</head>
+<body>
+<div class="container-fluid">
+<form class="row g-2 my-2 mx-1" method="get">
+<input class="form-control col" type="text" name="q" value="{html.escape(query)}" placeholder='errors:"Timeout with MCU" AND config:octopus'>
+<input class="form-control col-1" type="number" name="days" value="{days:g}" min="0" title="days, 0 for all">
+<button class="btn btn-outline-secondary col-1" type="submit">Search</button>
+</form>
+'''
+
+  for result in results:
+    timestr = datetime.datetime.fromtimestamp(result['mtime']).strftime('%d-%m-%Y %H:%M:%S')
+    response += '<div class="row mb-2 mt-2 mx-1">'
+    response += f'<a type="button" class="btn btn-outline-secondary col-2" href="/klipper_logs/{result["digest"]}">{timestr}</a>'
+    response += f'<pre class="col mb-0">{result["snippet"]}</pre>'
+    response += '</div>'
+
+  if query and not results:
+    response += '<div class="alert alert-info mx-1" role="alert">nothing found</div>'
+
+  response += '</div></body></html>'
+
+  response = web.Response(text=response)
+  response.headers['Content-Type'] = 'text/html'
+  return response
+
+def stats_table(title, rows, columns=None):
+  # rows maps a label to a count or to a dict of counts by column
+  response = f'<h5 class="mt-3">{html.escape(title)}</h5><table class="table table-sm table-striped"><thead><tr><th></th>'
+  if columns is None:
+    response += '<th>logs</th></tr></thead><tbody>'
+    for label, value in sorted(rows.items(), key=lambda r: -r[1]):
+      response += f'<tr><td>{html.escape(label)}</td><td>{value}</td></tr>'
+  else:
+    response += ''.join(f'<th>{html.escape(c)}</th>' for c in columns) + '</tr></thead><tbody>'
+    for label in sorted(rows):
+      response += f'<tr><td>{html.escape(label)}</td>' + ''.join(f'<td>{rows[label].get(c, 0)}</td>' for c in columns) + '</tr>'
+  return response + '</tbody></table>'
+
+async def handle_stats(request: web.Request) -> web.StreamResponse:
+  stats = rollups.current
+  if request.query.get('format') == 'json':
+    return web.json_response(stats)
+
+  response = '''<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Klipper Log Parser</title>
+<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-rbsA2VBKQhggwzxH7pPCaAqO46MgnOM80zW1RWuH61DGLwZJEdK2Kadq2F9CUG65" crossorigin="anonymous">
+</head>
+<body>
+<div class="container-fluid">
+'''
+
+  if not stats:
+    response += '<div class="alert alert-info m-2" role="alert">statistics are not computed yet</div>'
+  else:
+    generated = datetime.datetime.fromtimestamp(stats['generated']).strftime('%d-%m-%Y %H:%M:%S')
+    restarts = stats['unexpected_restarts']
+    response += f'<div class="alert alert-secondary m-2" role="alert">{stats["logs"]} parsed logs, generated at {generated}, '
+    response += f'{stats["versions_ok"]} with matching versions, {restarts["logs"]} with {restarts["total"]} unexpected restarts</div>'
+
+    columns = sorted(stats['errors'], key=lambda c: -stats['errors'][c])
+    response += stats_table('Errors in last session', stats['errors'])
+    response += stats_table('Errors by MCU firmware version', stats['errors_by_version'], columns)
+    response += stats_table('Errors by MCU type', stats['errors_by_mcu'], columns)
+    response += stats_table('Logs by MCU firmware version', stats['logs_by_version'])
+    response += stats_table('Logs by MCU type', stats['logs_by_mcu'])
+    response += stats_table('Config warnings', stats['warnings'])
+
+  response += '</div></body></html>'
+
+  response = web.Response(text=response)
+  response.headers['Content-Type'] = 'text/html'
+  return response
+
+RENDER_WORKERS = 2
+
+# server processes started by run(), their render workers share the cpus
+server_processes = 1
+
+# render queue priorities, lower first
+PRIORITY_UPLOAD = 0
+PRIORITY_VIEW = 1
+
+render_executor = None
+
+def get_render_executor():
+  global render_executor
+  if render_executor is None:
+    render_executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=share_cpus, initargs=(RENDER_WORKERS * server_processes,))
+  return render_executor
+
+def render_lock(digest):
+  return f'cache/{digest}.lock'
+
+def render_log(digest, profile=''):
+  # runs in a render worker process, returns the size of the page and the
+  # render profile if it was profiled
+  store = storage.get()
+  outfile = store.path(f'{digest}.html')
+  with file_lock(render_lock(digest)):
+    # another server process may have rendered it while this one waited
+    entry = catalog.get(digest)
+    if not profile and entry is not None and entry['html_size'] is not None and store.exists(f'{digest}.html'):
+      return entry['html_size'], None
+
+    take_profile()
+    summary = process_logfile(digest, outfile, profile)
+    html_size = os.path.getsize(outfile)
+    store.put(f'{digest}.html', outfile)
+    catalog.rendered(digest, html_size, summary)
+  return html_size, take_profile()
+
+render_scheduler = None
+render_errors = {}
+
+# comma separated addresses of the proxies in front of the server, the
+# address a trusted proxy appends to X-Forwarded-For is taken as the client.
+# A proxy on the same host is trusted unless the setting says otherwise.
+TRUSTED_PROXIES_ENV = 'KLIPPER_LOGS_TRUSTED_PROXIES'
+TRUSTED_PROXIES = '127.0.0.1,::1'
+
+def trusted_proxies():
+  return {p.strip() for p in os.environ.get(TRUSTED_PROXIES_ENV, TRUSTED_PROXIES).split(',') if p.strip()}
+
+def client_id(request):
+  # earlier X-Forwarded-For entries come from the client itself, only the
+  # last one, added by the proxy, can be trusted
+  remote = request.remote or ''
+  forwarded = request.headers.get('X-Forwarded-For', '')
+  if forwarded and remote in trusted_proxies():
+    return forwarded.split(',')[-1].strip() or remote
+  return remote
+
+def queue_render(digest, client, priority=PRIORITY_VIEW, profile=''):
+  # raises QueueFull when the queue or the share of client in it is full
+  is_new = render_scheduler.get(digest) is None
+  entry = catalog.get(digest)
+  job = render_scheduler.submit(digest, entry['size'] if entry else 0, client, priority, profile)
+  if is_new:
+    render_errors.pop(digest, None)
+    renders_pending.inc()
+  return job
+
+async def render_worker():
+  loop = asyncio.get_running_loop()
+  while True:
+    job = await render_scheduler.next()
+    start = perf_counter()
+    try:
+      html_size, profile = await loop.run_in_executor(get_render_executor(), render_log, job.digest, job.profile)
+      if profile is not None:
+        record_profile(profile)
+    except Exception as e:
+      logging.exception('render of %s failed', job.digest)
+      render_errors[job.digest] = str(e) or e.__class__.__name__
+      html_size = None
+    finally:
+      renders_pending.dec()
+      render_seconds.observe(perf_counter() - start)
+    render_scheduler.done(job, html_size)
+
+async def renders_ctx(app):
+  global render_scheduler
+  render_scheduler = RenderScheduler(RENDER_WORKERS)
+  tasks = [asyncio.create_task(render_worker()) for _ in range(RENDER_WORKERS)]
+  yield
+  for task in tasks:
+    task.cancel()
+
+def prerender(digest, request):
+  # uploads are rendered right away, ahead of renders started by page views
+  entry = catalog.get(digest)
+  if entry is not None and entry['html_size'] is not None:
+    return
+  try:
+    queue_render(digest, client_id(request), PRIORITY_UPLOAD)
+  except QueueFull:
+    renders_rejected.inc()
+    logging.info('render queue is full, %s is rendered when it is viewed\n', digest)
+
+def render_status(digest):
+  job = render_scheduler.get(digest)
+  if job is not None:
+    if digest in render_scheduler.running:
+      return {'state': 'rendering', 'position': render_scheduler.position(digest), 'progress': progress.read(digest)}
+    return {'state': 'queued', 'position': render_scheduler.position(digest)}
+  if digest in render_errors:
+    return {'state': 'failed', 'error': render_errors[digest]}
+  entry = catalog.get(digest)
+  if entry is None:
+    return {'state': 'missing'}
+  return {'state': 'done' if entry['html_size'] is not None else 'pending'}
+
+def progress_page(digest, retry_after=None):
+  # 202 page polling the render status, with retry_after the render was not
+  # accepted and the page is loaded again after that many seconds
+  status = render_status(digest)
+  if retry_after is not None:
+    message = f'Server is busy, parsing will be tried again in {retry_after} seconds'
+  else:
+    message = f'Log is {status["state"]}, the page will open when it is ready'
+  retry = retry_after or 5
+  response = f'''<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Klipper Log Parser</title>
+<link href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-rbsA2VBKQhggwzxH7pPCaAqO46MgnOM80zW1RWuH61DGLwZJEdK2Kadq2F9CUG65" crossorigin="anonymous">
+</head>
+<body>
+<div class="container-fluid">
+<p class="text-start"><a href="/klipper_logs">Home</a><br/><a href="/klipper_logs/{digest}.log">Download klippy logfile</a></p>
+<div class="alert alert-info m-2" role="alert" id="status">{message}</div>
+<div class="progress m-2" style="height: 1.5rem"><div class="progress-bar" role="progressbar" id="bar" style="width: 0%"></div></div>
+</div>
+<script>
+const messages = {{
+  queued: (s) => `Log is queued for parsing, ${{s.position}} ahead`,
+  rendering: (s) => s.progress ? `Log is being parsed, ${{s.progress.lines}} lines, ${{s.progress.lines_per_second}} lines/s` : 'Log is being parsed',
+  pending: (s) => 'Server is busy, waiting for a free place in the queue',
+  failed: (s) => `Parsing failed: ${{s.error}}`,
+}};
+// returns true while more updates are expected
+function show(status) {{
+  if (status.state == 'done') {{
+    location.reload();
+    return false;
+  }}
+  const node = document.getElementById('status');
+  node.textContent = (messages[status.state] || ((s) => s.state))(status);
+  if (status.progress) {{
+    const bar = document.getElementById('bar');
+    bar.style.width = `${{status.progress.percent}}%`;
+    bar.textContent = `${{status.progress.percent}}%`;
+  }}
+  if (status.state == 'failed') {{
+    node.className = 'alert alert-danger m-2';
+    return false;
+  }}
+  if (status.state == 'pending') {{
+    // not queued, loading the page queues it
+    setTimeout(() => location.reload(), {retry * 1000});
+    return false;
+  }}
+  return true;
+}}
+async function poll() {{
+  const status = await (await fetch('render/{digest}', {{cache: 'no-store'}})).json();
+  if (show(status))
+    setTimeout(poll, 1000);
+}}
+function listen() {{
+  const events = new EventSource('render/{digest}/events');
+  events.onmessage = (e) => {{
+    if (!show(JSON.parse(e.data)))
+      events.close();
+  }};
+  events.onerror = () => {{
+    events.close();
+    setTimeout(poll, 1000);
+  }};
+}}
+setTimeout(window.EventSource ? listen : poll, {0 if retry_after is None else retry * 1000});
+</script>
+</body></html>'''
+  return web.Response(status=202, text=response, content_type='text/html',
+                      headers={'Cache-Control': 'no-store', 'Retry-After': str(retry)})
+
+async def handle_render_status(request: web.Request) -> web.StreamResponse:
+  name = request.match_info.get("name", "invalid")
+  return web.json_response(render_status(name), headers={'Cache-Control': 'no-store'})
+
+RENDER_EVENT_INTERVAL = 0.5
+
+async def handle_render_events(request: web.Request) -> web.StreamResponse:
+  # server-sent events with the render status of one log, the stream ends
+  # when the render is no longer queued or running
+  name = request.match_info.get("name", "invalid")
+  response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-store'})
+  await response.prepare(request)
+
+  last = None
+  try:
+    while True:
+      status = render_status(name)
+      data = json.dumps(status)
+      if data != last:
+        await response.write(f'data: {data}\n\n'.encode())
+        last = data
+      if status['state'] not in ('queued', 'rendering'):
+        break
+      await asyncio.sleep(RENDER_EVENT_INTERVAL)
+  except ConnectionResetError:
+    pass
+  return response
+
+async def handle_renders(request: web.Request) -> web.StreamResponse:
+  # running and queued renders for operators, slowest running first
+  now = time.monotonic()
+  running = [{'digest': job.digest, 'size': job.size, 'priority': job.priority, 'progress': progress.read(job.digest)}
+             for job in render_scheduler.running.values()]
+  running.sort(key=lambda r: r['progress']['lines_per_second'] if r['progress'] else 0)
+  queued = [{'digest': job.digest, 'size': job.size, 'priority': job.priority, 'waiting': round(now - job.queued_at, 1)}
+            for job in render_scheduler.order(now)]
+  return web.json_response({'running': running, 'queued': queued}, headers={'Cache-Control': 'no-store'})
+
 async def handle_log(request: web.Request) -> web.StreamResponse:
   name = request.match_info.get("name", "invalid")
+  profile = request_profile(request.query.get('profile', ''))
   logfile = f'cache/{name}.log'
   outfile = f'cache/{name}.html'
 #  gzfile = f'cache/{name}.html.gz'
   logging.info('serving log file %s\n', logfile)
-  if os.path.exists(logfile):
+  if not catalog.is_digest(name):
+    # companion logs and other files in cache/ are not klippy logs
+    raise web.HTTPFound(location='/klipper_logs')
+  if render_scheduler.get(name) is not None and not profile:
+    return progress_page(name)
+
+  entry = catalog.get(name)
+  if entry is None:
+    # logs copied into cache/ by hand are picked up on first view
+    entry = await storage_call(catalog.add, name)
+  if entry is not None:
     logging.info('existing log file %s\n', logfile)
-    if os.path.exists(outfile) and os.path.getsize(outfile) < 1000:
+    html_size = entry['html_size']
+    if html_size is not None and (html_size < 1000 or profile):
       logging.info('removing cache file %s\n', outfile)
-      os.remove(outfile)
-    if not os.path.exists(outfile):
+      await storage_call(storage.get().remove, f'{name}.html')
+      hot_cache.discard(f'{name}.html')
+      html_size = None
+    if html_size is None:
       logging.info('do process log file %s\n', logfile)
-      process_logfile(name, outfile)
-  if os.path.exists(outfile):
+      html_cache.inc(result='miss')
+      try:
+        job = queue_render(name, client_id(request), PRIORITY_VIEW, profile)
+      except QueueFull as e:
+        renders_rejected.inc()
+        return progress_page(name, e.retry_after)
+      if not profile:
+        return progress_page(name)
+      # profiled renders are waited for, the page shows the timings
+      if await job.future is None:
+        raise web.HTTPInternalServerError(text=f'render failed: {render_errors.get(name, "")}')
+      entry = catalog.get(name)
+    else:
+      html_cache.inc(result='hit')
+    catalog.touch(name)
     logging.info('existing cache file %s\n', outfile)
 #    if not os.path.exists(gzfile):
 #      logging.info('compressing cache file %s\n', outfile)
@@ -1610,35 +2449,120 @@ async def handle_log(request: web.Request) -> web.StreamResponse:
 #        with gzip.open(gzfile, mode='wb', compresslevel=9) as f_out:
 #          shutil.copyfileobj(f_in, f_out)
 #    logging.info('serving gzip file %s\n', gzfile)
-    return web.FileResponse(outfile)
+    response = await serve_object(request, f'{name}.html', PAGE_CACHE_CONTROL, 'text/html', entry['rendered'])
+    if response is None:
+      # the page was dropped since the catalog entry was read, render again
+      await storage_call(catalog.add, name)
+      raise web.HTTPFound(location=f'/klipper_logs/{name}')
+    return response
 
   raise web.HTTPFound(location='/klipper_logs')
 
+async def storage_call(method, name):
+  # storage calls can go over the network, keep them off the event loop
+  return await asyncio.get_running_loop().run_in_executor(None, method, name)
+
+# pages are revalidated since adding a companion log renders them again,
+# stored logs never change
+PAGE_CACHE_CONTROL = 'public, no-cache'
+RAW_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+hot_cache = HotCache()
+
+async def serve_object(request, name, cache_control, content_type, version=None):
+  # response for a stored object, from memory when it is requested often,
+  # None if it is not stored. Both ways carry the same strong etag.
+  headers = {'Cache-Control': cache_control}
+  ranged = 'Range' in request.headers
+  entry = hot_cache.get(name, version) if not ranged else None
+  if entry is None:
+    filename = await storage_call(storage.get().fetch, name)
+    if filename is None:
+      return None
+    if not ranged and hot_cache.hot(name, os.path.getsize(filename)):
+      entry = await asyncio.get_running_loop().run_in_executor(None, read_entry, filename, version)
+      hot_cache.put(name, entry)
+    else:
+      hot_responses.inc(result='miss')
+      response = web.FileResponse(filename, chunk_size=256 * 1024, headers=headers)
+      response.headers['Content-Type'] = content_type
+      return response
+  hot_responses.inc(result='hit')
+
+  if request.if_none_match and any(etag.value in (entry.etag, '*') for etag in request.if_none_match):
+    response = web.Response(status=304, headers=headers)
+  else:
+    response = web.Response(body=entry.body, headers=headers)
+    response.headers['Content-Type'] = content_type
+    response.last_modified = entry.mtime
+  response.etag = entry.etag
+  return response
+
+async def handle_metrics(request: web.Request) -> web.StreamResponse:
+  response = web.Response(text=metrics.expose())
+  response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+  return response
+
 async def handle_log_static(request: web.Request) -> web.StreamResponse:
   name = request.match_info.get("name", "invalid")
-  file = f'cache/{name}.log'
-  logging.info('serving static log file %s\n', file)
-  if os.path.exists(file):
-    response = web.FileResponse(file, chunk_size=256 * 1024)
-    response.headers['Content-Type'] = 'text/plain'
+  logging.info('serving static log file %s.log\n', name)
+  # logs in memory are kept for the upload time of their catalog entry, an
+  # expired upload is not served from memory after its files are gone
+  digest = name.split('_')[0]
+  entry = None
+  if catalog.is_digest(digest):
+    entry = catalog.get(digest) or await storage_call(catalog.add, digest)
+  if entry is None:
+    hot_cache.discard(f'{name}.log')
+    raise web.HTTPFound(location='/klipper_logs')
+
+  if 'tail' in request.query:
+    response = await serve_tail(request, f'{name}.log', entry['mtime'])
+  else:
+    response = await serve_object(request, f'{name}.log', RAW_CACHE_CONTROL, 'text/plain', entry['mtime'])
+  if response is not None:
     return response
 
   raise web.HTTPFound(location='/klipper_logs')
 
+TAIL_MAX = 100000
+
+def read_tail(filename, count):
+  with open_mmap(filename) as mm:
+    return mm[tail_start(mm, count):]
+
+async def serve_tail(request, name, version=None):
+  # the last lines of a stored log, ?tail=N, None if it is not stored
+  try:
+    count = int(request.query['tail'])
+  except ValueError:
+    raise web.HTTPBadRequest(text='tail must be a number')
+  if count < 1 or count > TAIL_MAX:
+    raise web.HTTPBadRequest(text=f'tail must be between 1 and {TAIL_MAX}')
+
+  entry = hot_cache.get(name, version)
+  if entry is not None:
+    body = entry.body[tail_start(entry.body, count):]
+  else:
+    filename = await storage_call(storage.get().fetch, name)
+    if filename is None:
+      return None
+    body = await asyncio.get_running_loop().run_in_executor(None, read_tail, filename, count)
+  return web.Response(body=body, content_type='text/plain', headers={'Cache-Control': RAW_CACHE_CONTROL})
+
 async def read_field(field, filename):
   d = hashlib.md5()
   size = 0
   with open(filename, 'wb') as f:
-    try:
-      while True:
-        chunk = await field.read_chunk()  # 8192 bytes by default.
-        if not chunk:
-          break
-        size += len(chunk)
-        f.write(chunk)
-        d.update(chunk)
-    except:
-      logging.warn(f'exception while processing {field} for {filename}')
+    while True:
+      chunk = await field.read_chunk()  # 8192 bytes by default.
+      if not chunk:
+        break
+      size += len(chunk)
+      f.write(chunk)
+      d.update(chunk)
+
+  upload_bytes.inc(size, field=field.name)
 
   digest = d.hexdigest()
   print('received file', digest)
@@ -1646,19 +2570,96 @@ async def read_field(field, filename):
 
 _100MB = 1024 * 1024 * 100
 
+# multipart fields of a plain upload and their cache file suffixes
+form_fields = {
+  'logfile': '.log',
+  'moonraker': '_moonraker.log',
+  'dmesg': '_dmesg.log',
+  'debug': '_debug.log',
+}
+
+def remove_files(files):
+  for filename in files:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+def extract_tarball(tarname):
+  # unpacks the known logs of an uploaded tarball into a temporary directory,
+  # returns (digest, klippy log file, {suffix: companion file}, directory)
+  temp_dest = os.path.join('cache/', str(random.getrandbits(128)))
+  digest = ''
+  logfile = ''
+  companions = {}
+  try:
+    with tarfile.open(tarname, "r:*") as tar:
+      print('content of tarfile:')
+      for member in tar.getmembers():
+        print(member.name, member.size)
+        if member.size > _100MB or member.size < 100:
+          raise UploadError(f'{member.name} size {member.size} is out of range')
+
+        if not member.isfile():
+          raise UploadError(f'{member.name} is not a file')
+
+        if not member.name in tar_members:
+          continue
+
+        print('found', member.name)
+        tar.extract(member, path=temp_dest)
+        filename = os.path.join(temp_dest, member.name)
+        if member.name == 'klippy.log':
+          logfile = filename
+          with open(filename) as f, mmap(f.fileno(), 0, access=ACCESS_READ) as file:
+            digest = hashlib.md5(file).hexdigest()
+        else:
+          companions[tar_members[member.name]] = filename
+  except (tarfile.TarError, UploadError) as e:
+    shutil.rmtree(temp_dest, ignore_errors=True)
+    raise UploadError(f'invalid tarball: {e}')
+
+  return digest, logfile, companions, temp_dest
+
+def store_upload(digest, logfile, companions, tempdir=''):
+  # moves an uploaded klippy log and its companion logs into storage,
+  # companion logs added to an existing upload drop its rendered page
+  store = storage.get()
+  filename = f'{digest}.log'
+  html_name = f'{digest}.html'
+  logging.info('file: %s md5: %s\n', filename, digest)
+
+  result = 'existing' if store.exists(filename) else 'new'
+  if result == 'new':
+    store.put(filename, logfile)
+  else:
+    os.remove(logfile)
+
+  for suffix, tempname in companions.items():
+    name = f'{digest}{suffix}'
+    if result == 'existing' and store.exists(name):
+      os.remove(tempname)
+      continue
+    store.put(name, tempname)
+    if result == 'existing' and store.exists(html_name):
+      store.remove(html_name)
+
+  if tempdir:
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+  catalog.add(digest)
+  return result
+
+@metrics.timed(upload_seconds)
 async def upload_log(request: web.Request) -> web.StreamResponse:
   logging.info('serrving upload file\n')
+  uploads_total.inc()
   reader = await request.multipart()
 
   digest = ''
 
   tempname = ''
-  moonraker = ''
-  dmesg = ''
-  debug = ''
-  crownest = ''
-  telegram = ''
   tarname = ''
+  companions = {}
+  tempfiles = []
 
   try:
     while True:
@@ -1666,181 +2667,355 @@ async def upload_log(request: web.Request) -> web.StreamResponse:
       if field is None:
         break
 
-      fields = []
+      if field.name != 'tarfile' and not field.name in form_fields:
+        continue
+
+      print('received', field.name)
+      filename = os.path.join('cache/', str(random.getrandbits(128)))
+      tempfiles += [filename]
+      size, field_digest = await read_field(field, filename)
+      if size < 100:
+        os.remove(filename)
+        continue
 
       if field.name == 'tarfile':
-        print('received compressed logs')
-        tarname = os.path.join('cache/', str(random.getrandbits(128)))
-        size, digest = await read_field(field, tarname)
-        if size < 100:
-          os.remove(tarname)
-          tarname = ''
-
-      if field.name == 'logfile':
-        print('received klippy log')
-        tempname = os.path.join('cache/', str(random.getrandbits(128)))
-        size, digest = await read_field(field, tempname)
-        if size < 100:
-          os.remove(tempname)
-          tempname = ''
-
-      if field.name == 'moonraker':
-        print('received moonraker log')
-        moonraker = os.path.join('cache/', str(random.getrandbits(128)))
-        size, _ = await read_field(field, moonraker)
-        if size < 100:
-          os.remove(moonraker)
-          moonraker = ''
-
-      if field.name == 'dmesg':
-        print('received dmesg log')
-        dmesg = os.path.join('cache/', str(random.getrandbits(128)))
-        size, _ = await read_field(field, dmesg)
-        if size < 100:
-          os.remove(dmesg)
-          dmesg = ''
-
-      if field.name == 'debug':
-        print('received debug log')
-        debug = os.path.join('cache/', str(random.getrandbits(128)))
-        size, _ = await read_field(field, debug)
-        if size < 100:
-          os.remove(debug)
-          debug = ''
-  except:
-    logging.warn('Exception reading fields')
+        tarname = filename
+      elif field.name == 'logfile':
+        tempname = filename
+        digest = field_digest
+      else:
+        companions[form_fields[field.name]] = filename
+  except Exception:
+    logging.exception('upload interrupted')
+    remove_files(tempfiles)
+    raise web.HTTPBadRequest(text='upload interrupted, please try again')
 
+  tempdir = ''
   if tarname:
-    tar = tarfile.open(tarname, "r:xz")
-    print('content of tarfile:')
-    temp_dest = os.path.join('cache/', digest)
-    for member in tar.getmembers():
-      print(member.name, member.size)
-      if member.size > _100MB or member.size < 100:
-        print('File too big')
-        raise web.HTTPFound(location=f'/klipper_logs')
-        break
-
-      if not member.isfile():
-        print('Not a file')
-        raise web.HTTPFound(location=f'/klipper_logs')
-        break
-
-      if member.name == 'klippy.log':
-        print('found klippy log')
-        tempname = os.path.join(temp_dest, member.name)
-        tar.extract(member, path=temp_dest)
-        with open(tempname) as f,  mmap(f.fileno(), 0, access=ACCESS_READ) as file:
-          digest = hashlib.md5(file).hexdigest()
-
-      if member.name == 'moonraker.log':
-        print('found moonraker log')
-        moonraker = os.path.join(temp_dest, member.name)
-        tar.extract(member, path=temp_dest)
-
-      if member.name == 'dmesg.txt':
-        print('found dmesg log')
-        dmesg = os.path.join(temp_dest, member.name)
-        tar.extract(member, path=temp_dest)
-
-      if member.name == 'debug.txt':
-        print('found debug log')
-        debug = os.path.join(temp_dest, member.name)
-        tar.extract(member, path=temp_dest)
-
-      if member.name == 'crownest.log':
-        print('found crownest log')
-        crownest = os.path.join(temp_dest, member.name)
-        tar.extract(member, path=temp_dest)
-
-      if member.name == 'telegram.log':
-        print('found telegram log')
-        telegram = os.path.join(temp_dest, member.name)
-        tar.extract(member, path=temp_dest)
-
+    try:
+      digest, tar_log, tar_companions, tempdir = extract_tarball(tarname)
+    except UploadError as e:
+      logging.warning('rejected upload: %s\n', e)
+      remove_files(tempfiles)
+      raise web.HTTPFound(location=f'/klipper_logs')
 
-    os.remove(tarname)
-    tarname = temp_dest
+    # logs in the tarball take precedence over separate fields
+    remove_files([tarname, tempname] + [companions[s] for s in tar_companions if s in companions])
+    tempname = tar_log
+    companions.update(tar_companions)
 
   if tempname == '':
     print('tempname is empty')
+    remove_files(companions.values())
+    if tempdir:
+      shutil.rmtree(tempdir, ignore_errors=True)
     raise web.HTTPFound(location=f'/klipper_logs')
-    return
 
-  filename = f'cache/{digest}.log'
-  moonraker_name = f'cache/{digest}_moonraker.log'
-  dmesg_name = f'cache/{digest}_dmesg.log'
-  debug_name = f'cache/{digest}_debug.log'
-  crownest_name = f'cache/{digest}_crownest.log'
-  telegram_name = f'cache/{digest}_telegram.log'
-  html_name = f'cache/{digest}.html'
+  result = await asyncio.get_running_loop().run_in_executor(None, store_upload, digest, tempname, companions, tempdir)
+  uploads_stored.inc(result=result)
+  prerender(digest, request)
+  print('serving', result, digest)
+  raise web.HTTPFound(location=f'/klipper_logs/{digest}')
 
-  logging.info('file: %s md5: %s\n', filename, digest)
+# resumable uploads in progress, id -> (UploadSession, lock serializing its requests)
+upload_sessions = {}
+
+async def upload_session(request):
+  id = request.match_info.get('id', '')
+  if len(id) != 32 or any(c not in '0123456789abcdef' for c in id):
+    raise web.HTTPNotFound(text='unknown upload session')
+
+  entry = upload_sessions.get(id)
+  if entry is None:
+    if not UploadSession.exists(id):
+      raise web.HTTPNotFound(text='unknown upload session')
+    reserve_session()
+    entry = upload_sessions[id] = (UploadSession(id), asyncio.Lock())
+  entry[0].touched = time.monotonic()
+  return entry
+
+def release_sessions(idle=SESSION_IDLE):
+  # drops the stream state of uploads not continued for idle seconds or
+  # pruned from cache/, an upload that continues later replays its chunks
+  now = time.monotonic()
+  for id, (session, lock) in list(upload_sessions.items()):
+    if lock.locked():
+      continue
+    if now - session.touched > idle or not UploadSession.exists(id):
+      upload_sessions.pop(id)
+      session.tar.close()
+
+def reserve_session():
+  # room for one more session in memory, raises 503 when all are busy
+  if len(upload_sessions) >= SESSIONS_MAX:
+    release_sessions()
+  if len(upload_sessions) >= SESSIONS_MAX:
+    raise web.HTTPServiceUnavailable(text='too many uploads in progress, try again later', headers={'Retry-After': str(SESSION_RETRY)})
+
+async def load_session(session):
+  # sessions of a previous server run, or continued by another server
+  # process, are rebuilt from their stored chunks
+  if not session.loaded or session.stale():
+    try:
+      await asyncio.get_running_loop().run_in_executor(None, session.resume)
+    except UploadError as e:
+      drop_session(session)
+      raise web.HTTPUnprocessableEntity(text=str(e))
+
+def drop_session(session):
+  upload_sessions.pop(session.id, None)
+  session.remove()
+
+def parse_checksum(value):
+  # 'md5 <hex digest>', as sent in the Upload-Checksum header
+  if not value:
+    return ''
+  algorithm, _, checksum = value.partition(' ')
+  if algorithm.lower() != 'md5':
+    raise web.HTTPBadRequest(text=f'unsupported checksum algorithm {algorithm}')
+  return checksum.strip().lower()
+
+async def handle_upload_create(request: web.Request) -> web.StreamResponse:
+  try:
+    length = int(request.headers.get('Upload-Length', 0))
+  except ValueError:
+    raise web.HTTPBadRequest(text='Upload-Length must be a number')
+  if length > UPLOAD_MAX:
+    raise web.HTTPRequestEntityTooLarge(max_size=UPLOAD_MAX, actual_size=length)
+
+  uploads_total.inc()
+  loop = asyncio.get_running_loop()
+  await loop.run_in_executor(None, prune_sessions)
+  release_sessions()
+  reserve_session()
+
+  id = f'{random.getrandbits(128):032x}'
+  session = UploadSession(id)
+  session.create()
+  upload_sessions[id] = (session, asyncio.Lock())
+  logging.info('created upload session %s for %d bytes\n', id, length)
+  return web.Response(status=201, text=id, headers={'Location': f'/klipper_logs/uploads/{id}'})
+
+async def handle_upload_offset(request: web.Request) -> web.StreamResponse:
+  session, lock = await upload_session(request)
+  async with lock:
+    await load_session(session)
+  return web.Response(text=str(session.offset), headers={'Upload-Offset': str(session.offset)})
+
+async def handle_upload_chunk(request: web.Request) -> web.StreamResponse:
+  try:
+    offset = int(request.headers['Upload-Offset'])
+  except (KeyError, ValueError):
+    raise web.HTTPBadRequest(text='Upload-Offset header is required')
+  checksum = parse_checksum(request.headers.get('Upload-Checksum', ''))
 
-  if not os.path.exists(filename):
-    os.rename(tempname, filename)
-  else: 
-    os.remove(tempname)
-    if moonraker:
-      if not os.path.exists(moonraker_name):
-        os.rename(moonraker, moonraker_name)
-        os.remove(html_name)
-      else:
-        os.remove(moonraker)
-    if dmesg:
-      if not os.path.exists(dmesg_name):
-        os.rename(dmesg, dmesg_name)
-        os.remove(html_name)
-      else:
-        os.remove(dmesg)
-    if debug:
-      if not os.path.exists(debug_name):
-        os.rename(debug, debug_name)
-        os.remove(html_name)
-      else:
-        os.remove(debug)
-    if crownest:
-      if not os.path.exists(crownest_name):
-        os.rename(crownest, crownest_name)
-        os.remove(html_name)
-      else:
-        os.remove(crownest)
-    if telegram:
-      if not os.path.exists(telegram_name):
-        os.rename(telegram, telegram_name)
-        os.remove(html_name)
-      else:
-        os.remove(telegram)
-    if tarname:
-      os.rmdir(tarname)
-    print('serving existing', digest)
-    raise web.HTTPFound(location=f'/klipper_logs/{digest}')
-    return
+  session, lock = await upload_session(request)
+
+  chunk = bytearray()
+  async for data in request.content.iter_any():
+    chunk += data
+    if len(chunk) > CHUNK_MAX:
+      raise web.HTTPRequestEntityTooLarge(max_size=CHUNK_MAX, actual_size=len(chunk))
+  upload_bytes.inc(len(chunk), field='chunk')
 
-  if moonraker != '':
-    os.rename(moonraker, moonraker_name)
+  async with lock:
+    await load_session(session)
+    if offset != session.offset:
+      raise web.HTTPConflict(text=str(session.offset), headers={'Upload-Offset': str(session.offset)})
+
+    try:
+      await asyncio.get_running_loop().run_in_executor(None, session.append, offset, bytes(chunk), checksum)
+    except ChunkError as e:
+      raise web.HTTPBadRequest(text=str(e), headers={'Upload-Offset': str(session.offset)})
+    except UploadError as e:
+      logging.warning('upload %s failed: %s\n', session.id, e)
+      drop_session(session)
+      raise web.HTTPUnprocessableEntity(text=str(e))
+
+  return web.Response(status=204, headers={'Upload-Offset': str(session.offset)})
+
+@metrics.timed(upload_seconds)
+async def handle_upload_finish(request: web.Request) -> web.StreamResponse:
+  checksum = parse_checksum(request.headers.get('Upload-Checksum', ''))
+  session, lock = await upload_session(request)
+
+  async with lock:
+    await load_session(session)
+    try:
+      digest, logfile, companions = session.finish(checksum)
+    except ChunkError as e:
+      raise web.HTTPConflict(text=str(e), headers={'Upload-Offset': str(session.offset)})
+    except UploadError as e:
+      logging.warning('upload %s failed: %s\n', session.id, e)
+      drop_session(session)
+      raise web.HTTPUnprocessableEntity(text=str(e))
+
+    result = await asyncio.get_running_loop().run_in_executor(None, store_upload, digest, logfile, companions, session.dest)
+    drop_session(session)
+
+  uploads_stored.inc(result=result)
+  prerender(digest, request)
+  print('serving', result, digest)
+  raise web.HTTPFound(location=f'/klipper_logs/{digest}')
 
-  if dmesg != '':
-    os.rename(dmesg, dmesg_name)
+async def handle_delta_hashes(request: web.Request) -> web.StreamResponse:
+  base = request.match_info.get('base', '')
+  try:
+    block = int(request.query.get('block', DELTA_BLOCK))
+  except ValueError:
+    raise web.HTTPBadRequest(text='block must be a number')
+  if block < DELTA_BLOCK_MIN or block > DELTA_BLOCK_MAX or block % DELTA_BLOCK_MIN:
+    raise web.HTTPBadRequest(text=f'block must be a multiple of {DELTA_BLOCK_MIN} up to {DELTA_BLOCK_MAX}')
+
+  entry = catalog.get(base)
+  if entry is None:
+    raise web.HTTPNotFound(text='unknown base log')
+
+  basefile = await storage_call(storage.get().fetch, f'{base}.log')
+  if basefile is None:
+    raise web.HTTPNotFound(text='unknown base log')
+  hashes = await asyncio.get_running_loop().run_in_executor(None, block_hashes, basefile, block)
+  return web.Response(text='\n'.join([str(entry['size'])] + hashes) + '\n')
+
+@metrics.timed(upload_seconds)
+async def handle_delta_upload(request: web.Request) -> web.StreamResponse:
+  # klippy.log rebuilt from the first offset bytes of a cached log and the
+  # xz compressed remainder, other logs come in an optional tarball
+  logging.info('serving delta upload\n')
+  uploads_total.inc()
+  reader = await request.multipart()
 
-  if debug != '':
-    os.rename(debug, debug_name)
+  params = {}
+  deltaname = ''
+  tarname = ''
+  tempfiles = []
 
-  if crownest != '':
-    os.rename(crownest, crownest_name)
+  try:
+    while True:
+      field = await reader.next()
+      if field is None:
+        break
 
-  if telegram != '':
-    os.rename(telegram, telegram_name)
+      if field.name in ('base', 'offset', 'checksum'):
+        params[field.name] = (await field.text()).strip()
+      elif field.name in ('delta', 'tarfile'):
+        filename = os.path.join('cache/', str(random.getrandbits(128)))
+        tempfiles += [filename]
+        await read_field(field, filename)
+        if field.name == 'delta':
+          deltaname = filename
+        else:
+          tarname = filename
+  except Exception:
+    logging.exception('delta upload interrupted')
+    remove_files(tempfiles)
+    raise web.HTTPBadRequest(text='upload interrupted, please try again')
 
-  if tarname:
-    os.rmdir(tarname)
+  base = params.get('base', '')
+  try:
+    offset = int(params.get('offset', ''))
+  except ValueError:
+    remove_files(tempfiles)
+    raise web.HTTPBadRequest(text='offset must be a number')
+  if offset < 0 or offset % DELTA_BLOCK_MIN:
+    remove_files(tempfiles)
+    raise web.HTTPBadRequest(text=f'offset must be a multiple of {DELTA_BLOCK_MIN}')
+  if not deltaname:
+    remove_files(tempfiles)
+    raise web.HTTPBadRequest(text='delta is missing')
+  basefile = await storage_call(storage.get().fetch, f'{base}.log') if catalog.get(base) is not None else None
+  if basefile is None:
+    remove_files(tempfiles)
+    raise web.HTTPConflict(text='unknown base log, upload the full log')
+
+  logname = os.path.join('cache/', str(random.getrandbits(128)))
+  tempfiles += [logname]
+  loop = asyncio.get_running_loop()
+  try:
+    digest = await loop.run_in_executor(None, rebuild_log, basefile, offset, deltaname, logname, params.get('checksum', ''))
+    companions = {}
+    tempdir = ''
+    if tarname:
+      _, _, companions, tempdir = extract_tarball(tarname)
+  except UploadError as e:
+    logging.warning('rejected delta upload: %s\n', e)
+    remove_files(tempfiles)
+    raise web.HTTPUnprocessableEntity(text=str(e))
+  except Exception:
+    remove_files(tempfiles)
+    raise
+
+  remove_files([deltaname, tarname])
+  logging.info('delta upload reused %d bytes of %s\n', offset, base)
+  upload_bytes.inc(offset, field='reused')
 
-  print('serving', digest)
+  try:
+    result = await loop.run_in_executor(None, store_upload, digest, logname, companions, tempdir)
+  finally:
+    remove_files([logname])
+    if tempdir:
+      shutil.rmtree(tempdir, ignore_errors=True)
+  uploads_stored.inc(result=result)
+  prerender(digest, request)
+  print('serving', result, digest)
   raise web.HTTPFound(location=f'/klipper_logs/{digest}')
 
-def run(port=8998):
-  logging.basicConfig(level=logging.INFO)
-
+async def monitor_loop_lag(interval=1.):
+  loop = asyncio.get_running_loop()
+  while True:
+    start = loop.time()
+    await asyncio.sleep(interval)
+    lag = max(0., loop.time() - start - interval)
+    loop_lag.set(lag)
+    loop_lag_seconds.observe(lag)
+
+async def loop_lag_ctx(app):
+  task = asyncio.create_task(monitor_loop_lag())
+  yield
+  task.cancel()
+
+CACHE_SIZE_INTERVAL = 60.
+
+async def monitor_cache_size(interval=CACHE_SIZE_INTERVAL):
+  # walking cache/ gets slow as it grows, so it is not done on scrapes
+  loop = asyncio.get_running_loop()
+  while True:
+    try:
+      sizes = await loop.run_in_executor(None, cache_dir_size)
+      for kind, size in sizes.items():
+        cache_bytes.set(size, kind=kind)
+    except OSError:
+      logging.exception('cache size scan failed')
+    await asyncio.sleep(interval)
+
+async def cache_size_ctx(app):
+  task = asyncio.create_task(monitor_cache_size())
+  yield
+  task.cancel()
+
+LEADER_LOCK = 'cache/leader.lock'
+
+async def refresh_rollups(interval=rollups.ROLLUP_INTERVAL):
+  # of several server processes only the one holding the leader lock
+  # refreshes the rollups, the others load what it wrote
+  loop = asyncio.get_running_loop()
+  leader = None
+  while True:
+    if leader is None:
+      leader = try_lock(LEADER_LOCK)
+    try:
+      await loop.run_in_executor(None, rollups.refresh if leader else rollups.load)
+    except Exception:
+      logging.exception('rollups refresh failed')
+    await asyncio.sleep(interval)
+
+async def rollups_ctx(app):
+  rollups.load()
+  task = asyncio.create_task(refresh_rollups())
+  yield
+  task.cancel()
+
+def make_app():
   app = web.Application()
   app.add_routes(
     [
@@ -1854,6 +3029,30 @@ def run(port=8998):
       web.get("//getlogs", handle_getlogs),
       web.get("/getlogdev", handle_getlogdev),
       web.get("//getlogdev", handle_getlogdev),
+      web.get("/metrics", handle_metrics),
+      web.get("//metrics", handle_metrics),
+      web.get("/search", handle_search),
+      web.get("//search", handle_search),
+      web.get("/stats", handle_stats),
+      web.get("//stats", handle_stats),
+      web.get("/render/{name}", handle_render_status),
+      web.get("//render/{name}", handle_render_status),
+      web.get("/render/{name}/events", handle_render_events),
+      web.get("//render/{name}/events", handle_render_events),
+      web.get("/renders", handle_renders),
+      web.get("//renders", handle_renders),
+      web.post("/uploads", handle_upload_create),
+      web.post("//uploads", handle_upload_create),
+      web.get("/uploads/{id}", handle_upload_offset),
+      web.get("//uploads/{id}", handle_upload_offset),
+      web.patch("/uploads/{id}", handle_upload_chunk),
+      web.patch("//uploads/{id}", handle_upload_chunk),
+      web.post("/uploads/{id}", handle_upload_finish),
+      web.post("//uploads/{id}", handle_upload_finish),
+      web.get("/delta/{base}", handle_delta_hashes),
+      web.get("//delta/{base}", handle_delta_hashes),
+      web.post("/delta", handle_delta_upload),
+      web.post("//delta", handle_delta_upload),
       web.get("/{name}.log", handle_log_static),
       web.get("//{name}.log", handle_log_static),
       web.get("/index_{lang}.json", handle_lang),
@@ -1866,17 +3065,102 @@ def run(port=8998):
       web.post("//upload", upload_log),
     ]
   )
+  app.cleanup_ctx.append(loop_lag_ctx)
+  app.cleanup_ctx.append(cache_size_ctx)
+  app.cleanup_ctx.append(rollups_ctx)
+  app.cleanup_ctx.append(renders_ctx)
+
+  return app
+
+def serve(port, reuse_port=False, servers=1):
+  global server_processes
+  server_processes = servers
+  logging.basicConfig(level=logging.INFO)
+  try:
+    web.run_app(make_app(), port=port, reuse_port=reuse_port)
+  except KeyboardInterrupt:
+    pass
+
+# a server process exiting within RESTART_FAST seconds of its start is
+# restarted after a delay doubling from RESTART_DELAY, RESTART_FAILURES of
+# these in a row stop the server
+RESTART_FAST = 10.
+RESTART_DELAY = 1.
+RESTART_DELAY_MAX = 60.
+RESTART_FAILURES = 6
+
+def run(port=8998, workers=1):
+  # with several workers every process listens on the port with SO_REUSEPORT
+  # and the kernel spreads the connections, the catalog, search index and
+  # cache files are shared and renders are serialized by file locks
+  logging.basicConfig(level=logging.INFO)
+
+  catalog.sync()
+
+  if workers <= 1:
+    serve(port)
+    logging.info('Stopping http server...\n')
+    return
+
+  context = multiprocessing.get_context('spawn')
+  processes = {}
+  started = {}
+  failures = {n: 0 for n in range(workers)}
+  restarts = {}
+  failed = False
+
+  def start(n):
+    process = processes[n] = context.Process(target=serve, args=(port, True, workers), name=f'server-{n}')
+    process.start()
+    started[n] = time.monotonic()
+    logging.info('started server process %d pid %d\n', n, process.pid)
+
+  for n in range(workers):
+    start(n)
+
+  # stop the server processes too when the supervisor is terminated
+  def stop(signum, frame):
+    raise KeyboardInterrupt
+  signal.signal(signal.SIGTERM, stop)
 
   try:
-    web.run_app(app, port=port)
+    while not failed:
+      timeout = max(0., min(restarts.values()) - time.monotonic()) if restarts else None
+      multiprocessing.connection.wait([p.sentinel for p in processes.values()], timeout)
+      now = time.monotonic()
+      for n, process in list(processes.items()):
+        if process.is_alive():
+          continue
+        del processes[n]
+        failures[n] = failures[n] + 1 if now - started[n] < RESTART_FAST else 0
+        if failures[n] >= RESTART_FAILURES:
+          logging.error('server process %d failed %d times in a row, stopping\n', n, failures[n])
+          failed = True
+          break
+        delay = min(RESTART_DELAY * 2 ** (failures[n] - 1), RESTART_DELAY_MAX) if failures[n] else 0.
+        logging.warning('server process %d exited with %s, restarting in %.0fs\n', n, process.exitcode, delay)
+        restarts[n] = now + delay
+      for n, at in list(restarts.items()):
+        if at <= now and not failed:
+          del restarts[n]
+          start(n)
   except KeyboardInterrupt:
     pass
+
   logging.info('Stopping http server...\n')
+  for process in processes.values():
+    process.terminate()
+  for process in processes.values():
+    process.join(10)
+  if failed:
+    sys.exit(1)
 
 if __name__ == '__main__':
   from sys import argv
 
-  if len(argv) == 2:
+  if len(argv) == 3:
+    run(port=int(argv[1]), workers=int(argv[2]))
+  elif len(argv) == 2:
     run(port=int(argv[1]))
   else:
     run()
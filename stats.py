@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+
+# Stats fields kept for charts, matched against the part after 'name:'
+FILTER_KEYS = frozenset((
+  'date', 'sampletime',
+  'temp', 'target', 'pwm', 'fan_speed',
+  'freq', 'adj',
+  'cputime', 'cpudelta', 'sysload', 'memavail',
+  'buffer_time', 'print_stall', 'bytes_write', 'bytes_retransmit', 'mcu_task_avg', 'mcu_task_stddev', 'print_time'
+))
+
+KIND_FLOAT = 0
+KIND_PERCENT = 1
+KIND_MEMAVAIL = 2
+KIND_SYSLOAD = 3
+
+KINDS = {
+  'pwm': KIND_PERCENT,
+  'fan_speed': KIND_PERCENT,
+  'memavail': KIND_MEMAVAIL,
+  'sysload': KIND_SYSLOAD,
+}
+
+COLUMN_NAME = 0
+COLUMN_VALUE = 1
+COLUMN_SKIP = 2
+
+
+class StatsParser:
+  # Stats lines keep the same layout for a whole klippy session, so the
+  # column layout (token prefix, interned chart key, value kind and mcu stats
+  # label) is learned once per token count and then only verified per line.
+
+  def __init__(self):
+    self.layouts = {}
+
+  def learn(self, tokens):
+    layout = []
+    name = ''
+    for it in tokens:
+      if it.endswith(':'):
+        name = it[:-1]
+        layout += [(COLUMN_NAME, it, 0, None, 0, f'[{name}]: ')]
+        continue
+
+      tmp = it.split('=')
+      if len(tmp) != 2:
+        layout += [(COLUMN_SKIP, '', 0, None, 0, '')]
+        continue
+
+      key = tmp[0]
+      prefix = key + '='
+      chart_key = sys.intern(f'{name}:{key}') if key in FILTER_KEYS else None
+      layout += [(COLUMN_VALUE, prefix, len(prefix), chart_key, KINDS.get(key, KIND_FLOAT), f'{key}: ')]
+    return layout
+
+  def apply(self, layout, tokens, item):
+    text = []
+    for it, (column, prefix, plen, chart_key, kind, label) in zip(tokens, layout):
+      if column == COLUMN_VALUE:
+        if not it.startswith(prefix):
+          return None
+        v = it[plen:]
+        if '=' in v:
+          return None
+        text += [label, v, ' ']
+        if chart_key is None:
+          continue
+        value = round(float(v), 6)
+        if kind:
+          if kind == KIND_PERCENT:
+            value = int(value * 100)
+          elif kind == KIND_MEMAVAIL:
+            value = value / 1024.
+          else:
+            value = value * 100.
+        item[chart_key] = value
+
+      elif column == COLUMN_NAME:
+        if it != prefix:
+          return None
+        text += [label]
+
+      elif it.endswith(':') or it.count('=') == 1:
+        return None
+    return ''.join(text)
+
+  def parse(self, tokens, item):
+    # fills item with the chart fields and returns the mcu stats text
+    n = len(tokens)
+    layout = self.layouts.get(n)
+    if layout is not None:
+      fields = {}
+      text = self.apply(layout, tokens, fields)
+      if text is not None:
+        item.update(fields)
+        return text
+
+    layout = self.learn(tokens)
+    self.layouts[n] = layout
+    return self.apply(layout, tokens, item)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import random
+import shutil
+import logging
+
+try:
+  import boto3
+  from botocore.exceptions import ClientError
+except ImportError:
+  boto3 = None
+
+
+# 's3://bucket/prefix' stores the logs in an S3 compatible bucket, the
+# endpoint is only needed for stores other than AWS (MinIO and the like)
+STORAGE_ENV = 'KLIPPER_LOGS_STORAGE'
+S3_ENDPOINT_ENV = 'KLIPPER_LOGS_S3_ENDPOINT'
+CACHE_MAX_ENV = 'KLIPPER_LOGS_CACHE_MAX'
+
+CACHE_DIR = 'cache'
+
+# bytes of stored objects kept in cache/ when the store is remote
+CACHE_MAX = 1024 * 1024 * 1024 * 4
+
+COPY_CHUNK = 1024 * 1024
+
+# seconds a local copy is kept after fetch() returned it, whoever got the
+# path may not have opened the file yet
+EVICT_GRACE = 300
+
+
+def is_object(name):
+  # uploaded logs and rendered pages are stored, everything else in cache/
+  # (locks, progress, segments, databases, uploads in progress) is local
+  return name.endswith(('.log', '.html')) and not name.startswith('upload_')
+
+
+class LocalStorage:
+  # The objects are the files in cache/ itself.
+
+  def __init__(self, root=CACHE_DIR):
+    self.root = root
+
+  def path(self, name):
+    return os.path.join(self.root, name)
+
+  def stat(self, name):
+    # (size, mtime) of a stored object, None if there is none
+    try:
+      st = os.stat(self.path(name))
+    except OSError:
+      return None
+    return st.st_size, st.st_mtime
+
+  def exists(self, name):
+    return self.stat(name) is not None
+
+  def listing(self):
+    # {name: (size, mtime)} of every stored object
+    objects = {}
+    for entry in os.scandir(self.root):
+      if is_object(entry.name):
+        st = entry.stat()
+        objects[entry.name] = (st.st_size, st.st_mtime)
+    return objects
+
+  def fetch(self, name):
+    # local file of an object, None if it is not stored
+    path = self.path(name)
+    return path if os.path.exists(path) else None
+
+  def put(self, name, filename):
+    # stores filename as name, the file is moved
+    path = self.path(name)
+    if os.path.abspath(filename) != os.path.abspath(path):
+      os.replace(filename, path)
+
+  def remove(self, name):
+    try:
+      os.remove(self.path(name))
+    except FileNotFoundError:
+      pass
+
+
+class S3Storage(LocalStorage):
+  # Objects live in an S3 compatible bucket. cache/ is a read-through copy
+  # of the objects used recently, the least recently used copies are dropped
+  # beyond cache_max bytes. Logs never change once stored, a page is
+  # removed when a companion log is added and rendered again.
+
+  def __init__(self, bucket, prefix='', endpoint_url=None, root=CACHE_DIR, cache_max=CACHE_MAX):
+    if boto3 is None:
+      raise RuntimeError('S3 storage needs boto3, pip install boto3')
+    super().__init__(root)
+    self.client = boto3.client('s3', endpoint_url=endpoint_url)
+    self.bucket = bucket
+    self.prefix = prefix.rstrip('/') + '/' if prefix else ''
+    self.cache_max = cache_max
+
+  def key(self, name):
+    return self.prefix + name
+
+  def stat(self, name):
+    try:
+      head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+        return None
+      raise
+    return head['ContentLength'], head['LastModified'].timestamp()
+
+  def listing(self):
+    objects = {}
+    paginator = self.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+      for obj in page.get('Contents', []):
+        name = obj['Key'][len(self.prefix):]
+        if is_object(name):
+          objects[name] = (obj['Size'], obj['LastModified'].timestamp())
+    return objects
+
+  def fetch(self, name):
+    path = self.path(name)
+    try:
+      # the access time orders the copies for eviction, the modification
+      # time stays the upload time of the object
+      st = os.stat(path)
+      os.utime(path, (time.time(), st.st_mtime))
+      return path
+    except FileNotFoundError:
+      pass
+
+    try:
+      obj = self.client.get_object(Bucket=self.bucket, Key=self.key(name))
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+        return None
+      raise
+
+    tempname = f'{path}.{random.getrandbits(64)}.tmp'
+    try:
+      with open(tempname, 'wb') as f:
+        shutil.copyfileobj(obj['Body'], f, COPY_CHUNK)
+      os.utime(tempname, (time.time(), obj['LastModified'].timestamp()))
+      os.replace(tempname, path)
+    finally:
+      if os.path.exists(tempname):
+        os.remove(tempname)
+
+    logging.info('fetched %s from the object store\n', name)
+    self.evict()
+    return path
+
+  def put(self, name, filename):
+    self.client.upload_file(filename, self.bucket, self.key(name))
+    super().put(name, filename)
+    self.evict()
+
+  def remove(self, name):
+    self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+    super().remove(name)
+
+  def evict(self):
+    # drops the least recently used local copies beyond cache_max, a render
+    # still reading a dropped copy keeps it open until it is done. Copies
+    # fetched within EVICT_GRACE seconds stay, cache/ can be over cache_max
+    # for that long.
+    grace = time.time() - EVICT_GRACE
+    copies = []
+    for entry in os.scandir(self.root):
+      if is_object(entry.name):
+        try:
+          st = entry.stat()
+        except FileNotFoundError:
+          continue
+        copies += [(st.st_atime, st.st_size, entry.path)]
+
+    total = sum(size for _, size, _ in copies)
+    for atime, size, path in sorted(copies):
+      if total <= self.cache_max or atime > grace:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+
+
+store = None
+
+def open_storage():
+  spec = os.environ.get(STORAGE_ENV, '')
+  if not spec:
+    return LocalStorage()
+  if not spec.startswith('s3://'):
+    raise ValueError(f'{STORAGE_ENV} must be empty or s3://bucket/prefix, not {spec}')
+  bucket, _, prefix = spec[len('s3://'):].partition('/')
+  cache_max = int(os.environ.get(CACHE_MAX_ENV, CACHE_MAX))
+  return S3Storage(bucket, prefix, os.environ.get(S3_ENDPOINT_ENV) or None, cache_max=cache_max)
+
+def get():
+  # storage of this process, opened on first use so render workers spawned
+  # with the same environment use the same store
+  global store
+  if store is None:
+    store = open_storage()
+  return store
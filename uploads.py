@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import lzma
+import fcntl
+import shutil
+import hashlib
+import logging
+import tarfile
+
+from logscan import map_file
+
+
+# log files looked for in uploaded tarballs and their cache file suffixes
+tar_members = {
+  'klippy.log': '.log',
+  'moonraker.log': '_moonraker.log',
+  'dmesg.txt': '_dmesg.log',
+  'debug.txt': '_debug.log',
+  'crownest.log': '_crownest.log',
+  'telegram.log': '_telegram.log',
+}
+
+MEMBER_MIN = 100
+MEMBER_MAX = 1024 * 1024 * 100
+
+CHUNK_MAX = 1024 * 1024 * 8
+UPLOAD_MAX = 1024 * 1024 * 200
+SESSION_TTL = 86400
+
+# uploads kept in memory by a server process, the stream state of one not
+# continued for SESSION_IDLE seconds is dropped and rebuilt when it is
+SESSIONS_MAX = 64
+SESSION_IDLE = 600
+SESSION_RETRY = 60
+
+# decompressed bytes produced per step, bounds memory for highly compressed logs
+INFLATE_STEP = 1024 * 1024 * 4
+
+BLOCK = tarfile.BLOCKSIZE
+NUL_BLOCK = tarfile.NUL * BLOCK
+
+
+class UploadError(Exception):
+  pass
+
+class ChunkError(UploadError):
+  # the request was rejected but the upload can go on
+  pass
+
+
+class TarStream:
+  # Incremental reader of an uncompressed tar stream. Known log members are
+  # written to dest while the data arrives and klippy.log is hashed on the way.
+
+  def __init__(self, dest):
+    self.dest = dest
+    self.buf = b''
+    self.file = None
+    self.hash = None
+    self.remaining = 0
+    self.padding = 0
+    self.files = {}
+    self.digest = ''
+    self.done = False
+
+  def header(self, block):
+    if block == NUL_BLOCK:
+      self.done = True
+      return
+
+    try:
+      info = tarfile.TarInfo.frombuf(block, 'utf-8', 'surrogateescape')
+    except tarfile.HeaderError as e:
+      raise UploadError(f'invalid tar header: {e}')
+
+    self.remaining = info.size
+    self.padding = -info.size % BLOCK
+
+    name = os.path.basename(info.name)
+    if not info.isreg() or not name in tar_members or info.size < MEMBER_MIN:
+      return
+    if info.size > MEMBER_MAX:
+      raise UploadError(f'{name} is too big')
+
+    filename = os.path.join(self.dest, name)
+    self.file = open(filename, 'wb')
+    self.files[name] = filename
+    if name == 'klippy.log':
+      self.hash = hashlib.md5()
+
+  def data(self, chunk):
+    if self.file is not None:
+      self.file.write(chunk)
+      if self.hash is not None:
+        self.hash.update(chunk)
+
+    self.remaining -= len(chunk)
+    if self.remaining == 0 and self.file is not None:
+      self.file.close()
+      self.file = None
+      if self.hash is not None:
+        self.digest = self.hash.hexdigest()
+        self.hash = None
+
+  def feed(self, data):
+    buf = memoryview(self.buf + data if self.buf else data)
+    pos = 0
+    end = len(buf)
+    while pos < end and not self.done:
+      if self.remaining:
+        n = min(self.remaining, end - pos)
+        self.data(buf[pos:pos + n])
+        pos += n
+      elif self.padding:
+        n = min(self.padding, end - pos)
+        self.padding -= n
+        pos += n
+      elif end - pos >= BLOCK:
+        self.header(bytes(buf[pos:pos + BLOCK]))
+        pos += BLOCK
+      else:
+        break
+    self.buf = bytes(buf[pos:]) if not self.done else b''
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+class UploadSession:
+  # A resumable upload of a compressed log tarball. Chunks are appended to
+  # cache/upload_{id}.part and decompressed and unpacked as they arrive, so
+  # finishing the upload only has to move the extracted files.
+
+  def __init__(self, id):
+    self.id = id
+    self.partname = f'cache/upload_{id}.part'
+    self.dest = f'cache/upload_{id}'
+    self.touched = time.monotonic()
+    self.reset()
+
+  def reset(self):
+    self.offset = 0
+    self.md5 = hashlib.md5()
+    self.inflate = lzma.LZMADecompressor()
+    self.tar = TarStream(self.dest)
+    self.loaded = False
+
+  @staticmethod
+  def exists(id):
+    return os.path.exists(f'cache/upload_{id}.part')
+
+  def create(self):
+    os.makedirs(self.dest, exist_ok=True)
+    open(self.partname, 'wb').close()
+    self.loaded = True
+
+  def stale(self):
+    # another server process appended chunks since this one loaded the upload
+    try:
+      return os.path.getsize(self.partname) != self.offset
+    except OSError:
+      return True
+
+  def resume(self):
+    # the stream state is not persistent, replay the chunks already stored
+    self.tar.close()
+    self.reset()
+    shutil.rmtree(self.dest, ignore_errors=True)
+    os.makedirs(self.dest)
+    with open(self.partname, 'rb') as f:
+      # no chunk is appended by another process while the stored ones replay
+      fcntl.flock(f, fcntl.LOCK_SH)
+      while True:
+        chunk = f.read(CHUNK_MAX)
+        if not chunk:
+          break
+        self.process(chunk)
+        self.offset += len(chunk)
+    self.loaded = True
+
+  def process(self, chunk):
+    self.md5.update(chunk)
+    data = chunk
+    while not self.inflate.eof:
+      try:
+        out = self.inflate.decompress(data, INFLATE_STEP)
+      except lzma.LZMAError as e:
+        raise UploadError(f'invalid xz data: {e}')
+      data = b''
+      self.tar.feed(out)
+      if self.inflate.needs_input:
+        break
+
+  def append(self, offset, chunk, checksum=''):
+    if offset != self.offset:
+      raise ChunkError(f'offset {offset} does not match {self.offset}')
+    if checksum and hashlib.md5(chunk).hexdigest() != checksum:
+      raise ChunkError('chunk checksum mismatch')
+    if self.offset + len(chunk) > UPLOAD_MAX:
+      raise UploadError('upload is too big')
+
+    with open(self.partname, 'ab') as f:
+      # chunks of one upload can reach different server processes
+      fcntl.flock(f, fcntl.LOCK_EX)
+      if os.fstat(f.fileno()).st_size != self.offset:
+        raise ChunkError('upload was continued elsewhere, ask for the offset again')
+      self.process(chunk)
+      f.write(chunk)
+    self.offset += len(chunk)
+
+  def finish(self, checksum=''):
+    # returns (digest, klippy log file, {suffix: companion file})
+    if checksum and self.md5.hexdigest() != checksum:
+      raise UploadError('upload checksum mismatch')
+    if not self.inflate.eof or self.tar.remaining:
+      raise ChunkError('upload is incomplete')
+    self.tar.close()
+
+    files = self.tar.files
+    if not 'klippy.log' in files:
+      raise UploadError('klippy.log not found in upload')
+
+    logfile = files.pop('klippy.log')
+    return self.tar.digest, logfile, {tar_members[name]: filename for name, filename in files.items()}
+
+  def remove(self):
+    self.tar.close()
+    shutil.rmtree(self.dest, ignore_errors=True)
+    if os.path.exists(self.partname):
+      os.remove(self.partname)
+
+
+def prune_sessions(ttl=SESSION_TTL):
+  # drops uploads that were not resumed within ttl seconds
+  now = time.time()
+  for name in os.listdir('cache'):
+    if not name.startswith('upload_') or not name.endswith('.part'):
+      continue
+    partname = os.path.join('cache', name)
+    if now - os.path.getmtime(partname) > ttl:
+      logging.info('removing stale upload %s\n', partname)
+      shutil.rmtree(partname[:-5], ignore_errors=True)
+      os.remove(partname)
+
+
+DELTA_BLOCK = 1024 * 1024
+DELTA_BLOCK_MIN = 64 * 1024
+DELTA_BLOCK_MAX = 16 * 1024 * 1024
+
+
+def block_hashes(filename, block=DELTA_BLOCK):
+  # md5 of every full block of a cached log, a client compares these with
+  # its own file to find how much of the cached log it can reuse
+  hashes = []
+  with open(filename, 'rb') as f:
+    mm = map_file(f)
+    try:
+      for pos in range(0, len(mm) - block + 1, block):
+        hashes += [hashlib.md5(mm[pos:pos + block]).hexdigest()]
+    finally:
+      if mm:
+        mm.close()
+  return hashes
+
+def rebuild_log(basefile, offset, deltafile, dest, checksum):
+  # writes the first offset bytes of basefile followed by the xz compressed
+  # delta to dest, returns the md5 digest of the result
+  if offset < 0 or offset > os.path.getsize(basefile):
+    raise UploadError(f'offset {offset} is outside the base log')
+
+  d = hashlib.md5()
+  size = 0
+  with open(dest, 'wb') as out:
+    with open(basefile, 'rb') as f:
+      remaining = offset
+      while remaining:
+        chunk = f.read(min(remaining, INFLATE_STEP))
+        if not chunk:
+          raise UploadError(f'offset {offset} is beyond the base log')
+        out.write(chunk)
+        d.update(chunk)
+        remaining -= len(chunk)
+        size += len(chunk)
+
+    try:
+      with lzma.open(deltafile) as f:
+        while True:
+          chunk = f.read(INFLATE_STEP)
+          if not chunk:
+            break
+          size += len(chunk)
+          if size > MEMBER_MAX:
+            raise UploadError('klippy.log is too big')
+          out.write(chunk)
+          d.update(chunk)
+    except (lzma.LZMAError, EOFError) as e:
+      raise UploadError(f'invalid delta: {e}')
+
+  digest = d.hexdigest()
+  if checksum and digest != checksum:
+    raise UploadError('rebuilt log checksum mismatch')
+  return digest